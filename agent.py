@@ -0,0 +1,108 @@
+import argparse
+import json
+import socketserver
+import subprocess
+import sys
+import threading
+import time
+
+from experiment_runner import cleanup_processes
+
+# Node agent, one per host of a multi-host ring. The orchestrator connects
+# over TCP and sends one JSON request per line:
+#   ping            answered with the agent's receive and send wall clock
+#                   stamps, for the NTP-style offset and RTT estimate
+#   start nodes     starts one process.py per argv in `nodes`
+#   status          how many nodes still run, and the exit codes
+#   stop            terminates all nodes
+# Requests are not authenticated and `start` runs any process.py argv, whose
+# options create and remove files at the paths given. The agent therefore
+# only listens on loopback unless --host names another address, which should
+# be on a trusted network only.
+AGENT_PORT = 7600
+AGENT_HOST = "127.0.0.1"
+
+
+class Agent:
+    def __init__(self):
+        self.processes = []
+        self.lock = threading.Lock()
+
+    def start(self, nodes):
+        with self.lock:
+            if any(proc.poll() is None for proc in self.processes):
+                raise RuntimeError("nodes of the previous ring are still running")
+            self.processes = [
+                subprocess.Popen([sys.executable, "process.py"] + argv)
+                for argv in nodes
+            ]
+            return {"started": len(self.processes)}
+
+    def status(self):
+        with self.lock:
+            codes = [proc.poll() for proc in self.processes]
+        return {
+            "running": sum(code is None for code in codes),
+            "returncodes": [code for code in codes if code is not None],
+        }
+
+    def stop(self):
+        with self.lock:
+            cleanup_processes(self.processes)
+            return {"stopped": len(self.processes)}
+
+    def handle(self, request):
+        command = request.get("command")
+        if command == "start":
+            return self.start(request["nodes"])
+        if command == "status":
+            return self.status()
+        if command == "stop":
+            return self.stop()
+        raise ValueError(f"Unknown command {command!r}")
+
+
+class AgentHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            received = time.time()
+            try:
+                request = json.loads(line)
+                if request.get("command") == "ping":
+                    reply = {"received": received}
+                else:
+                    reply = self.server.agent.handle(request)
+            except Exception as e:
+                reply = {"error": str(e)}
+            # Stamped last, as close to the send as we can get
+            reply["sent"] = time.time()
+            self.wfile.write(json.dumps(reply).encode() + b"\n")
+            self.wfile.flush()
+
+
+class AgentServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address):
+        super().__init__(address, AgentHandler)
+        self.agent = Agent()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--host",
+        type=str,
+        default=AGENT_HOST,
+        help="Address to listen on, e.g. the host's address on a trusted network "
+        "for remote orchestrators",
+    )
+    parser.add_argument("--port", type=int, default=AGENT_PORT)
+    args = parser.parse_args()
+    with AgentServer((args.host, args.port)) as server:
+        print(f"[Agent] Listening on {args.host}:{args.port}")
+        try:
+            server.serve_forever()
+        finally:
+            server.agent.stop()
@@ -0,0 +1,478 @@
+import asyncio
+import argparse
+import os
+import random
+import resource
+import socket
+import sys
+import time
+
+from drops import set_buffer_sizes, socket_drops
+from histogram import LogHistogram
+from logs import add_logging_arguments, log, start_logging
+from memory import resident_memory
+from pacing import add_pacing_argument
+from profiler import StackSampler, add_profile_arguments, write_collapsed
+from process import (
+    TOKEN_TIMEOUT,
+    add_buffer_arguments,
+    add_multicast_arguments,
+    count_open_fds,
+    open_multicast_socket,
+    parse_address,
+    token_states,
+)
+from wire import (
+    DEFAULT_WIRE,
+    DONE,
+    READY,
+    SERVICE_TIME,
+    WIRE_FORMATS,
+    decode,
+    encode_control,
+    encode_firework,
+    encode_histogram,
+    encode_round_time,
+    encode_silent,
+    encode_token,
+    encode_token_lost,
+    message_format,
+)
+
+DEFAULT_BASE_PORT = 6000
+
+
+class RingNode(asyncio.DatagramProtocol):
+    # One ring member. Same decision logic as process.main, but driven by
+    # datagram callbacks instead of a blocking recvfrom loop.
+
+    def __init__(self, worker, node_id, next_addr, initial_p, k, tokens=1):
+        self.worker = worker
+        self.id = node_id
+        self.next_addr = next_addr
+        self.k = k
+        self.tokens = token_states(tokens, node_id, initial_p, worker.service)
+        self.remaining = tokens
+        self.timers = {}
+        self.transport = None
+        self.done = False
+        self.wire = "binary" if worker.wire == "auto" else worker.wire
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        if self.done:
+            return
+        received_at = time.monotonic()
+        self.worker.last_activity = received_at
+        if self.worker.wire == "auto":
+            self.wire = message_format(data)
+        token = decode(data)
+        state = self.tokens.get(token.get("token_id", 0))
+        if token["type"] == "stop":
+            if state:
+                state.stopped = True  # from the topology coordinator
+            return
+        if state is None or state.finished:
+            return
+        state.tracer.received()
+        new_epoch = state.guard.new_epoch(token)
+        if not state.guard.accept(token):
+            return  # stale copy of a regenerated token
+        if new_epoch:
+            state.tracer.last_forward_ns = None
+        self.arm_timer(state)
+        if token.get("silent_rounds") and token["silent_rounds"] >= self.k:
+            self.send_token(state, token)
+            self.token_finished(state)
+            return
+        state.rounds += 1
+        # Any firework for this token since the last visit resets the count
+        fireworks = self.worker.fireworks.get(state.id, 0)
+        if fireworks != state.heard:
+            state.heard = fireworks
+            state.silent = 0
+
+        pacer = self.worker.pacer
+        fired = random.random() < state.probability
+        if fired:
+            if not pacer.forward_first:
+                self.worker.multicast_firework(
+                    self.id, token["round"], self.wire, state.id
+                )
+            state.silent = 0
+        else:
+            state.silent += 1
+
+        state.probability /= 2
+        token["round"] += 1
+
+        if self.worker.coordinated and self.id == 0:
+            self.worker.report_silent(self.id, state.id, token["round"], state.silent)
+        if state.stopped if self.worker.coordinated else state.silent >= self.k:
+            log.info(
+                "[Process %s] Terminating token %s after %s rounds",
+                self.id,
+                state.id,
+                token["round"],
+            )
+            token["silent_rounds"] = max(state.silent, self.k)
+            self.send_token(state, token)
+            self.worker.multicast_termination(token, self.wire)
+            self.token_finished(state)
+            return
+
+        delay = pacer.delay(received_at)
+        if delay > 0:
+            self.worker.loop.call_later(delay, self.send_token, state, token)
+        else:
+            self.send_token(state, token)
+        if fired and pacer.forward_first:
+            self.worker.multicast_firework(
+                self.id, token["round"] - 1, self.wire, state.id
+            )
+
+    def send_token(self, state, token):
+        current_time = time.time()
+        round_ns = state.tracer.forwarded()
+
+        # Only one process, the process with ID 0 sends the round time, and
+        # only for full circuits, see process.send_token
+        if self.id == 0 and round_ns is not None:
+            self.worker.multicast_round_time(
+                round_ns / 1e9, token["round"], self.id, self.wire, state.id
+            )
+
+        token["timestamp"] = current_time
+        self.transport.sendto(encode_token(token, self.wire), self.next_addr)
+        state.guard.forwarded(token)
+
+    def arm_timer(self, state):
+        # Until the node has timed a full circuit the worker's own watchdog
+        # is the only timeout, as in process.main
+        timer = self.timers.pop(state.id, None)
+        if timer:
+            timer.cancel()
+        if state.guard.average is not None:
+            self.timers[state.id] = self.worker.loop.call_later(
+                state.guard.remaining(), self.token_lost, state
+            )
+
+    def token_lost(self, state):
+        self.timers.pop(state.id, None)
+        if self.done or state.finished:
+            return
+        if state.id in self.worker.terminated:
+            log.info(
+                "[Process %s] Token %s terminated, lost on the way.", self.id, state.id
+            )
+            self.token_finished(state)
+            return
+        token = state.guard.regenerate()
+        if token is None:
+            log.error("[Process %s] Giving up on token %s.", self.id, state.id)
+            self.token_finished(state)
+            return
+        log.warning(
+            "[Process %s] Token %s lost, injecting epoch %s in round %s",
+            self.id,
+            state.id,
+            token["epoch"],
+            token["round"],
+        )
+        self.worker.last_activity = time.monotonic()
+        self.worker.multicast_token_lost(self.id, token["epoch"], self.wire, state.id)
+        # The new epoch starts here, see process.regenerate_token
+        state.tracer.last_forward_ns = None
+        self.send_token(state, token)
+        self.arm_timer(state)
+
+    def token_finished(self, state):
+        state.finished = True
+        timer = self.timers.pop(state.id, None)
+        if timer:
+            timer.cancel()
+        self.remaining -= 1
+        if self.remaining == 0:
+            self.finish()
+
+    def finish(self):
+        self.done = True
+        for timer in self.timers.values():
+            timer.cancel()
+        self.timers.clear()
+        # The socket stays open until the worker is done, its drop counter
+        # goes away with it
+        self.worker.node_finished()
+
+
+class FireworkListener(asyncio.DatagramProtocol):
+    # A single multicast membership per worker. Fireworks are counted per
+    # token, each node compares the count with the one it last saw when the
+    # token arrives, as ShmTransport.poll does with its board, so a firework
+    # costs the same however many nodes the worker hosts. A multicast token
+    # means some node has terminated that token.
+
+    def __init__(self, worker):
+        self.worker = worker
+
+    def datagram_received(self, data, addr):
+        try:
+            message = decode(data)
+        except ValueError:
+            return
+        token_id = message.get("token_id", 0)
+        if message["type"] == "firework":
+            fireworks = self.worker.fireworks
+            fireworks[token_id] = fireworks.get(token_id, 0) + 1
+        elif message["type"] == "token":
+            self.worker.terminated.add(token_id)
+
+
+class RingWorker:
+    def __init__(self, args):
+        self.args = args
+        self.first = args.first
+        self.count = args.count
+        self.n = args.n
+        self.initial_p = args.initial_p
+        self.k = args.k
+        self.base_port = args.base_port
+        self.next_host = args.next_host
+        self.pacer = args.pacing
+        self.wire = args.wire
+        self.firework_addr = (args.firework_group, args.firework_port)
+        self.round_time_addr = (args.round_time_group, args.round_time_port)
+        self.nodes = []
+        self.fireworks = {}  # token id -> fireworks heard by this worker
+        self.service = LogHistogram()  # shared by all nodes of this worker
+        self.remaining = args.count
+        self.tokens = args.tokens
+        self.terminated = set()
+        self.loop = None
+        self.finished = None
+        self.last_activity = time.monotonic()
+        self.dropped = 0  # kernel receive drops of the sockets of this worker
+        self.send_sock = None
+        self.coordinated = args.coordinated
+
+    def multicast_firework(self, process_id, round_number, wire, token_id=0):
+        message = encode_firework(process_id, round_number, wire, token_id)
+        self.send_sock.sendto(message, self.firework_addr)
+
+    def multicast_round_time(
+        self, round_duration, round_number, process_id, wire, token_id=0
+    ):
+        message = encode_round_time(
+            round_duration, round_number, process_id, wire, token_id
+        )
+        self.send_sock.sendto(message, self.round_time_addr)
+
+    def multicast_termination(self, token, wire):
+        self.send_sock.sendto(encode_token(token, wire), self.firework_addr)
+
+    def multicast_token_lost(self, process_id, epoch, wire, token_id=0):
+        message = encode_token_lost(process_id, epoch, wire, token_id)
+        self.send_sock.sendto(message, self.round_time_addr)
+
+    def report_silent(self, process_id, token_id, round_number, silent):
+        if self.args.control:
+            message = encode_silent(process_id, token_id, round_number, silent)
+            self.send_sock.sendto(message, self.args.control)
+
+    def send_control(self, kind, rss=0, drops=0):
+        if self.args.control:
+            message = encode_control(
+                kind, self.first, self.count, rss=rss, drops=drops
+            )
+            self.send_sock.sendto(message, self.args.control)
+
+    def node_finished(self):
+        self.remaining -= 1
+        if self.remaining == 0 and not self.finished.done():
+            self.finished.set_result(True)
+
+    async def start(self):
+        self.loop = asyncio.get_running_loop()
+        self.finished = self.loop.create_future()
+
+        self.send_sock = socket.socket(
+            socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP
+        )
+        self.send_sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 1)
+        self.send_sock.setblocking(False)
+        set_buffer_sizes(self.send_sock, sndbuf=self.args.sndbuf)
+
+        mcast_sock = open_multicast_socket(*self.firework_addr)
+        set_buffer_sizes(mcast_sock, self.args.rcvbuf)
+        self.mcast_transport, _ = await self.loop.create_datagram_endpoint(
+            lambda: FireworkListener(self), sock=mcast_sock
+        )
+
+        next_ip = socket.gethostbyname(self.next_host)
+        for node_id in range(self.first, self.first + self.count):
+            next_addr = (next_ip, self.base_port + (node_id + 1) % self.n)
+            node = RingNode(
+                self, node_id, next_addr, self.initial_p, self.k, self.tokens
+            )
+            transport, _ = await self.loop.create_datagram_endpoint(
+                lambda node=node: node,
+                local_addr=("0.0.0.0", self.base_port + node_id),
+            )
+            set_buffer_sizes(transport.get_extra_info("socket"), self.args.rcvbuf)
+            self.nodes.append(node)
+
+        self.send_control(READY)
+        log.info(
+            "[Worker %s-%s] Hosting %s nodes on ports %s-%s",
+            self.first,
+            self.first + self.count - 1,
+            self.count,
+            self.base_port + self.first,
+            self.base_port + self.first + self.count - 1,
+        )
+
+    async def run(self):
+        await self.start()
+        try:
+            # Same failure mode as process.main: give up if no token shows up
+            # at any of our nodes for TOKEN_TIMEOUT seconds.
+            while not self.finished.done():
+                idle = time.monotonic() - self.last_activity
+                if idle > TOKEN_TIMEOUT:
+                    raise TimeoutError(
+                        f"No token received for {TOKEN_TIMEOUT} seconds"
+                    )
+                try:
+                    await asyncio.wait_for(
+                        asyncio.shield(self.finished), TOKEN_TIMEOUT - idle
+                    )
+                except asyncio.TimeoutError:
+                    continue
+            if self.args.control:
+                message = encode_histogram(self.first, SERVICE_TIME, self.service)
+                self.send_sock.sendto(message, self.args.control)
+            # One pass over /proc/net/udp for all sockets of the worker
+            self.dropped += socket_drops(
+                *(node.transport.get_extra_info("socket") for node in self.nodes),
+                self.mcast_transport.get_extra_info("socket"),
+            )
+            if self.dropped:
+                log.warning(
+                    "[Worker %s-%s] %s datagrams dropped",
+                    self.first,
+                    self.first + self.count - 1,
+                    self.dropped,
+                )
+            self.send_control(DONE, resident_memory(), self.dropped)
+        finally:
+            self.close()
+        log.info(
+            "[Worker %s-%s] All nodes done, %s fds still open.",
+            self.first,
+            self.first + self.count - 1,
+            count_open_fds(),
+        )
+
+    def close(self):
+        for node in self.nodes:
+            for timer in node.timers.values():
+                timer.cancel()
+            node.transport.close()
+        self.mcast_transport.close()
+        self.send_sock.close()
+
+
+def raise_fd_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def shard(n, workers):
+    # Contiguous blocks keep most hops inside one event loop; the token only
+    # crosses a process boundary once per worker per round.
+    workers = max(1, min(workers, n))
+    size, extra = divmod(n, workers)
+    first = 0
+    for w in range(workers):
+        count = size + (1 if w < extra else 0)
+        yield first, count
+        first += count
+
+
+def worker_commands(
+    n, workers, node_args, base_port=DEFAULT_BASE_PORT, python=sys.executable
+):
+    # node_args carries the per-node options process.py takes (--initial_p,
+    # --k, --pacing, ...), they are passed through unchanged
+    commands = []
+    for first, count in shard(n, workers):
+        commands.append(
+            [
+                python,
+                "async_ring.py",
+                "--first",
+                str(first),
+                "--count",
+                str(count),
+                "--n",
+                str(n),
+                "--base_port",
+                str(base_port),
+            ]
+            + node_args
+        )
+    return commands
+
+
+def main(args):
+    raise_fd_limit()
+    if not args.count:
+        args.count = args.n - args.first
+    stop_logging = start_logging(args.log_level, args.log_sample)
+    sampler = StackSampler(args.profile).start() if args.profile else None
+    try:
+        asyncio.run(RingWorker(args).run())
+    finally:
+        if sampler:
+            os.makedirs(args.profile_dir, exist_ok=True)
+            path = os.path.join(args.profile_dir, f"worker-{args.first}.folded")
+            write_collapsed(sampler.stop(), path)
+        stop_logging()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--n", type=int, required=True)
+    parser.add_argument("--first", type=int, default=0)
+    parser.add_argument("--count", type=int, default=None)
+    parser.add_argument("--base_port", type=int, default=DEFAULT_BASE_PORT)
+    parser.add_argument("--next_host", type=str, default="localhost")
+    parser.add_argument("--initial_p", type=float, default=0.5)
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--tokens", type=int, default=1)
+    add_pacing_argument(parser)
+    parser.add_argument(
+        "--wire",
+        choices=WIRE_FORMATS,
+        default=DEFAULT_WIRE,
+        help="Message format; auto answers in the format the token arrived in",
+    )
+    add_multicast_arguments(parser)
+    add_logging_arguments(parser)
+    add_buffer_arguments(parser)
+    add_profile_arguments(parser)
+    parser.add_argument(
+        "--coordinated",
+        action="store_true",
+        help="Segment of a topology, see process.py",
+    )
+    parser.add_argument(
+        "--control",
+        type=parse_address,
+        default=None,
+        help="HOST:PORT of the runner, notified when the nodes are ready and done",
+    )
+    main(parser.parse_args())
@@ -0,0 +1,327 @@
+import argparse
+import json
+import os
+import platform
+import socket
+import statistics
+import subprocess
+import sys
+import time
+
+from experiment_runner import add_mode_argument, run_single_ring
+from listener import RECV_BATCH, StatsListener
+from process import Sender, send_token
+from wire import encode_round_time, encode_token
+
+# Repeatable performance scenarios. Every scenario yields one sample per
+# metric and repetition; warmup repetitions are run first and thrown away.
+# Results are saved as JSON together with the commit and the machine they
+# were measured on, and `compare` flags metrics that got worse between two
+# result files.
+SCENARIOS = ("hop", "ingest", "ring", "startup")
+DEFAULT_REPETITIONS = 5
+DEFAULT_WARMUP = 1
+DEFAULT_THRESHOLD = 0.1  # relative change of the mean that counts as regression
+HOP_ITERATIONS = 20000
+INGEST_BATCH = 200  # datagrams per burst, stays below the default rcvbuf
+INGEST_BURSTS = 50
+INGEST_TIMEOUT_NS = 1_000_000_000  # per burst, whatever is missing was dropped
+BENCH_BASE_PORT = 16000
+BENCH_CHANNELS = {
+    "firework_group": "239.255.254.1",
+    "firework_port": 15007,
+    "round_time_group": "239.255.254.2",
+    "round_time_port": 15008,
+}
+# Two-sided 95% quantiles of Student's t by degrees of freedom, 1.96 beyond
+T_95 = [
+    12.706, 4.303, 3.182, 2.776, 2.571, 2.447, 2.365, 2.306, 2.262, 2.228,
+    2.201, 2.179, 2.160, 2.145, 2.131, 2.120, 2.110, 2.101, 2.093, 2.086,
+    2.080, 2.074, 2.069, 2.064, 2.060, 2.056, 2.052, 2.048, 2.045, 2.042,
+]  # fmt: skip
+
+
+def confidence_interval(samples):
+    mean = statistics.fmean(samples)
+    if len(samples) < 2:
+        return mean, 0.0, mean, mean
+    stdev = statistics.stdev(samples)
+    df = len(samples) - 1
+    t = T_95[df - 1] if df <= len(T_95) else 1.96
+    half = t * stdev / len(samples) ** 0.5
+    return mean, stdev, mean - half, mean + half
+
+
+def hop_benchmark(wire):
+    # Cost of one hop on the node side: encoding the token, and send_token
+    # as a whole (timing, encoding and the unicast send). Nodes other than
+    # 0 do not multicast round times, so neither do we.
+    sink = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sink.bind(("127.0.0.1", 0))
+    sender = Sender("127.0.0.1", sink.getsockname()[1])
+    token = {"round": 0, "silent_rounds": 0, "timestamp": time.time(), "sender": 1}
+    try:
+        started = time.perf_counter_ns()
+        for _ in range(HOP_ITERATIONS):
+            encode_token(token, wire)
+        encoded = time.perf_counter_ns()
+        for _ in range(HOP_ITERATIONS):
+            send_token(sender, token, 1, wire)
+        sent = time.perf_counter_ns()
+    finally:
+        sender.close()
+        sink.close()
+    return {
+        "encode_ns": (encoded - started) / HOP_ITERATIONS,
+        "send_token_ns": (sent - encoded) / HOP_ITERATIONS,
+    }
+
+
+def ingest_benchmark(wire):
+    # Round times per second the stats listener decodes and aggregates. The
+    # listener thread is not started, bursts are drained right here.
+    listener = StatsListener(BENCH_CHANNELS)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    addr = ("127.0.0.1", BENCH_CHANNELS["round_time_port"])
+    message = encode_round_time(0.001, 1, 0, wire)
+    elapsed = 0
+    total = 0
+    try:
+        for _ in range(INGEST_BURSTS):
+            for _ in range(INGEST_BATCH):
+                sock.sendto(message, addr)
+            received = 0
+            started = last = time.perf_counter_ns()
+            while received < INGEST_BATCH:
+                count = listener.drain(listener.round_time_sock, RECV_BATCH)
+                if count:
+                    received += count
+                    last = time.perf_counter_ns()
+                elif time.perf_counter_ns() - started > INGEST_TIMEOUT_NS:
+                    break  # the kernel dropped the rest of the burst
+            # Up to the last message, not the time spent waiting for drops
+            elapsed += last - started
+            total += received
+    finally:
+        sock.close()
+        listener.close()
+    return {"messages_per_sec": total / (elapsed / 1e9)}
+
+
+def ring_benchmark(n, mode, wire):
+    stats = run_single_ring(
+        n, 0.5, 5, mode, wire=wire, base_port=BENCH_BASE_PORT, channels=BENCH_CHANNELS
+    )
+    if not stats or not stats["rounds"]:
+        raise RuntimeError(f"Ring of {n} nodes reported no round times")
+    return {
+        "avg_time": stats["avg_time"],
+        "p50": stats["p50"],
+        "rounds_per_sec": stats["rounds_per_sec"],
+    }
+
+
+def startup_benchmark(n, mode, wire):
+    # k = 1 ends the ring at the first silent node, startup dominates. The
+    # time is taken at the READY handshake, the ring may well end before a
+    # full circuit.
+    stats = run_single_ring(
+        n, 0.5, 1, mode, wire=wire, base_port=BENCH_BASE_PORT, channels=BENCH_CHANNELS
+    )
+    if not stats:
+        raise RuntimeError(f"Ring of {n} nodes did not finish")
+    return {"startup_time": stats["startup_time"]}
+
+
+# Units, and whether a larger value is better, per metric
+METRICS = {
+    "encode_ns": ("ns", False),
+    "send_token_ns": ("ns", False),
+    "messages_per_sec": ("1/s", True),
+    "avg_time": ("s", False),
+    "p50": ("s", False),
+    "rounds_per_sec": ("1/s", True),
+    "startup_time": ("s", False),
+}
+
+
+def scenario_cases(scenario, sizes, mode, wires):
+    # (parameters, function returning the metrics of one repetition)
+    for wire in wires:
+        if scenario == "hop":
+            yield {"wire": wire}, lambda wire=wire: hop_benchmark(wire)
+        elif scenario == "ingest":
+            yield {"wire": wire}, lambda wire=wire: ingest_benchmark(wire)
+        else:
+            measure = ring_benchmark if scenario == "ring" else startup_benchmark
+            for n in sizes:
+                yield (
+                    {"n": n, "mode": mode, "wire": wire},
+                    lambda n=n, wire=wire, measure=measure: measure(n, mode, wire),
+                )
+
+
+def run_case(scenario, params, measure, repetitions, warmup):
+    for _ in range(warmup):
+        measure()
+    samples = {}
+    for _ in range(repetitions):
+        for metric, value in measure().items():
+            samples.setdefault(metric, []).append(value)
+    results = []
+    for metric, values in samples.items():
+        mean, stdev, low, high = confidence_interval(values)
+        unit, higher_is_better = METRICS[metric]
+        results.append(
+            {
+                "scenario": scenario,
+                "params": params,
+                "metric": metric,
+                "unit": unit,
+                "higher_is_better": higher_is_better,
+                "samples": values,
+                "mean": mean,
+                "stdev": stdev,
+                "ci95": [low, high],
+            }
+        )
+        print(
+            f"{scenario} {params} {metric}: {mean:.6g} {unit} "
+            f"(95% CI {low:.6g}..{high:.6g}, {len(values)} runs)"
+        )
+    return results
+
+
+def git_output(*args):
+    try:
+        return subprocess.run(
+            ["git", *args], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def cpu_model():
+    try:
+        with open("/proc/cpuinfo") as f:
+            for line in f:
+                if line.startswith("model name"):
+                    return line.partition(":")[2].strip()
+    except OSError:
+        pass
+    return platform.processor() or platform.machine()
+
+
+def environment():
+    status = git_output("status", "--porcelain", "--untracked-files=no")
+    return {
+        "commit": git_output("rev-parse", "HEAD"),
+        "dirty": bool(status) if status is not None else None,
+        "python": sys.version.split()[0],
+        "implementation": platform.python_implementation(),
+        "platform": platform.platform(),
+        "cpu": cpu_model(),
+        "cpu_count": os.cpu_count(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+    }
+
+
+def run(args):
+    metadata = environment()
+    metadata.update(repetitions=args.repetitions, warmup=args.warmup)
+    results = []
+    for scenario in args.scenario:
+        for params, measure in scenario_cases(scenario, args.n, args.mode, args.wire):
+            results.extend(
+                run_case(scenario, params, measure, args.repetitions, args.warmup)
+            )
+    output = args.output
+    if output is None:
+        commit = (metadata["commit"] or "unknown")[:8]
+        output = f"benchmark-{commit}-{time.strftime('%Y%m%d-%H%M%S')}.json"
+    with open(output, "w") as f:
+        json.dump({"metadata": metadata, "results": results}, f, indent=2)
+    print(f"Results written to {output}")
+
+
+def result_key(result):
+    params = json.dumps(result["params"], sort_keys=True)
+    return result["scenario"], params, result["metric"]
+
+
+def compare(args):
+    # Exits with 1 when any metric got worse by more than the threshold, with
+    # confidence intervals that do not overlap
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.candidate) as f:
+        candidate = json.load(f)
+    for name, data in (("baseline", baseline), ("candidate", candidate)):
+        meta = data["metadata"]
+        print(f"{name}: {meta['commit']} on {meta['cpu']}, Python {meta['python']}")
+    old = {result_key(result): result for result in baseline["results"]}
+    regressions = 0
+    for result in candidate["results"]:
+        before = old.get(result_key(result))
+        if before is None or not before["mean"]:
+            continue
+        change = (result["mean"] - before["mean"]) / before["mean"]
+        worse = -change if result["higher_is_better"] else change
+        # Changes the intervals cannot tell apart from noise are not flagged
+        overlap = (
+            result["ci95"][0] <= before["ci95"][1]
+            and before["ci95"][0] <= result["ci95"][1]
+        )
+        if abs(worse) <= args.threshold:
+            verdict = "ok"
+        elif overlap:
+            verdict = "noise"
+        elif worse > 0:
+            verdict = "REGRESSION"
+            regressions += 1
+        else:
+            verdict = "improved"
+        print(
+            f"{result['scenario']} {result['params']} {result['metric']}: "
+            f"{before['mean']:.6g} -> {result['mean']:.6g} {result['unit']} "
+            f"({change:+.1%}) {verdict}"
+        )
+    print(f"{regressions} regression(s) beyond {args.threshold:.0%}")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    commands = parser.add_subparsers(dest="command", required=True)
+    run_parser = commands.add_parser("run", help="Run scenarios and save results")
+    run_parser.add_argument(
+        "--scenario", choices=SCENARIOS, nargs="+", default=list(SCENARIOS)
+    )
+    run_parser.add_argument(
+        "--n", type=int, nargs="+", default=[10, 50], help="Ring sizes"
+    )
+    add_mode_argument(run_parser)
+    run_parser.add_argument(
+        "--wire", choices=["binary", "json"], nargs="+", default=["binary"]
+    )
+    run_parser.add_argument("--repetitions", type=int, default=DEFAULT_REPETITIONS)
+    run_parser.add_argument("--warmup", type=int, default=DEFAULT_WARMUP)
+    run_parser.add_argument(
+        "--output", type=str, default=None, help="JSON file, named by commit if unset"
+    )
+    compare_parser = commands.add_parser(
+        "compare", help="Flag regressions between two result files"
+    )
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("candidate")
+    compare_parser.add_argument(
+        "--threshold",
+        type=float,
+        default=DEFAULT_THRESHOLD,
+        help="Relative change of a mean that counts as a regression",
+    )
+    args = parser.parse_args()
+    if args.command == "run":
+        run(args)
+    else:
+        sys.exit(compare(args))
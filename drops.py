@@ -0,0 +1,75 @@
+import os
+import socket
+
+from logs import log
+
+# Kernel receive drops of UDP sockets. A datagram that arrives while the
+# socket's receive queue is full is dropped and only counted in the drops
+# column of /proc/net/udp, the receiver never learns about it. Sockets are
+# matched by inode. The sizes of the send and receive buffers are set with
+# SO_SNDBUF / SO_RCVBUF; the kernel caps them at net.core.wmem_max and
+# rmem_max and reports back twice what it granted (bookkeeping overhead).
+UDP_TABLES = ("/proc/net/udp", "/proc/net/udp6")
+DATAGRAM_TRUESIZE = 2304  # bytes of receive buffer one small datagram takes
+MIN_AUTO_RCVBUF = 256 * 1024
+capped = set()  # requested sizes already warned about by this process
+
+
+def socket_inode(sock):
+    return os.fstat(sock.fileno()).st_ino
+
+
+def socket_drops(*socks):
+    # Drops of the given sockets together, 0 where /proc is missing
+    inodes = {socket_inode(sock) for sock in socks}
+    drops = 0
+    for table in UDP_TABLES:
+        try:
+            with open(table) as f:
+                next(f, None)  # header
+                for line in f:
+                    fields = line.split()
+                    if int(fields[9]) in inodes:
+                        drops += int(fields[-1])
+        except (OSError, ValueError, IndexError):
+            pass
+    return drops
+
+
+def set_buffer_sizes(sock, rcvbuf=None, sndbuf=None):
+    # None keeps the OS default. Returns the receive buffer the kernel
+    # granted, in the units it was asked for.
+    if rcvbuf:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+    if sndbuf:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, sndbuf)
+    granted = sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF) // 2
+    if rcvbuf and granted < rcvbuf and rcvbuf not in capped:
+        # Once per process, a worker sets it on every socket it hosts
+        capped.add(rcvbuf)
+        log.warning(
+            "Receive buffer of %s bytes capped at %s, raise net.core.rmem_max",
+            rcvbuf,
+            granted,
+        )
+    return granted
+
+
+def granted_rcvbuf(rcvbuf=None):
+    # What a UDP socket of a node gets when it asks for rcvbuf
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        return set_buffer_sizes(sock, rcvbuf)
+    finally:
+        sock.close()
+
+
+def auto_rcvbuf(n, tokens=1):
+    # Room for every node of the ring firing for every token at once, the
+    # worst burst of fireworks a node or the listener has to queue
+    return max(MIN_AUTO_RCVBUF, n * tokens * DATAGRAM_TRUESIZE)
+
+
+def parse_buffer_size(value):
+    # "auto" is resolved by the runner, which knows n
+    return value if value == "auto" else int(value)
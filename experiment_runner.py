@@ -1,13 +1,39 @@
 import subprocess
 import time
 import socket
-import json
-import threading
-from statistics import mean
 import sys
 import csv
-import select
+import selectors
 import os
+import argparse
+import shutil
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from async_ring import shard, worker_commands
+from drops import auto_rcvbuf, granted_rcvbuf, parse_buffer_size
+from histogram import LogHistogram, percentiles
+from listener import SOCKET_RCVBUF, StatsListener
+from memory import MemorySampler
+from metrics import MetricsServer, Registry
+from node_pool import DEFAULT_START_METHOD, START_METHODS, NodePool
+from pacing import DEFAULT_PACING, add_pacing_argument
+from process import DEFAULT_LOOP, LOOPS
+from profiler import PROFILE_DIR, PROFILE_MODES, merge_directory
+from store import STORE_DIR, ResultStore, add_store_argument
+from transport import DEFAULT_TRANSPORT, TRANSPORTS, make_transport_dir
+from topology import (
+    DEFAULT_TOPOLOGY,
+    Coordinator,
+    TOPOLOGY_CSV_FIELDS,
+    TOPOLOGY_CSV_FILE,
+    level_rows,
+    parse_topology,
+    segment_channels,
+)
+from wire import decode, encode_token
 
 MULTICAST_GROUP_FIREWORKS = "224.0.0.1"
 MULTICAST_GROUP = "224.1.1.1"
@@ -15,57 +41,71 @@ MULTICAST_PORT_FIREWORKS = 5007
 MULTICAST_PORT_ROUND_TIMES = 5008
 BASE_PORT = 6000
 CSV_FILE = "experiment_results.csv"
+TOKEN_CSV_FILE = "token_results.csv"  # per-token breakdown of multi-token runs
+TIMEOUT_STARTUP = 60  # seconds until every node must have reported ready
+TIMEOUT_NO_PROGRESS = 120  # seconds without a new round time
+CONTROL_BUFFER_SIZE = 65536  # node reports carry whole histograms
+MODES = ("process", "async", "pool")
+DEFAULT_MODE = "process"
+DEFAULT_CHANNELS = {
+    "firework_group": MULTICAST_GROUP_FIREWORKS,
+    "firework_port": MULTICAST_PORT_FIREWORKS,
+    "round_time_group": MULTICAST_GROUP,
+    "round_time_port": MULTICAST_PORT_ROUND_TIMES,
+}
+CSV_FIELDS = [
+    "n",
+    "rounds",
+    "multicasts",
+    "min_time",
+    "max_time",
+    "avg_time",
+    "pacing",
+    "initial_p",
+    "k",
+    "p50",
+    "p90",
+    "p99",
+    "p999",
+    "hop_p50",
+    "hop_p99",
+    "lost_tokens",
+    "tokens",
+    "rounds_per_sec",
+    "startup_time",
+    "rss_per_node",
+    "uss_per_node",
+    "rss_total",
+    "uss_total",
+    "loop",
+    "run_id",
+    "dropped",
+    "rcvbuf",
+    "transport",
+    "profile",
+]
+TOKEN_CSV_FIELDS = [
+    "n",
+    "tokens",
+    "token",
+    "rounds",
+    "avg_time",
+    "p50",
+    "p99",
+    "pacing",
+    "initial_p",
+    "k",
+]
 
 
-def listen_for_stats(stop_event, round_times, multicast_count):
-    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)  # Add this line
-    sock.bind(("", MULTICAST_PORT_ROUND_TIMES))
-    group = socket.inet_aton(MULTICAST_GROUP)
-    mreq = group + socket.inet_aton("0.0.0.0")
-    sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
-    sock.settimeout(1.0)
-
-    # Fireworks socket
-    sock_fireworks = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    sock_fireworks.setsockopt(
-        socket.SOL_SOCKET, socket.SO_REUSEADDR, 1
-    )  # Add this line
-    sock_fireworks.bind(("", MULTICAST_PORT_FIREWORKS))
-    group_fireworks = socket.inet_aton(MULTICAST_GROUP_FIREWORKS)
-    mreq_fireworks = group_fireworks + socket.inet_aton("0.0.0.0")
-    sock_fireworks.setsockopt(
-        socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq_fireworks
+def add_mode_argument(parser):
+    parser.add_argument(
+        "--mode",
+        choices=MODES,
+        default=DEFAULT_MODE,
+        help="One OS process per node, many asyncio nodes per worker process, "
+        "or one node per warm pre-forked pool worker",
     )
-    sock_fireworks.settimeout(1.0)
-
-    while not stop_event.is_set():
-        try:
-            # Check for round time messages
-            ready_to_read, _, _ = select.select([sock, sock_fireworks], [], [], 1.0)
-            for ready_sock in ready_to_read:
-                data, _ = ready_sock.recvfrom(1024)
-                message = data.decode()
-                if ready_sock == sock:
-                    # Round time message
-                    message = json.loads(message)
-                    if message.get("type") == "round_time":
-                        print(
-                            f"Received round time: {message['duration']} in round {message['round']}"
-                        )
-                        round_times.append(message["duration"])
-                else:
-                    # Firework message
-                    if "Firework from" in message:
-                        multicast_count[0] += 1
-
-        except socket.timeout:
-            continue
-        except Exception as e:
-            print("Error receiving multicast:", e)
-
-    sock.close()
-    sock_fireworks.close()
 
 
 def cleanup_processes(processes):
@@ -77,110 +117,643 @@ def cleanup_processes(processes):
             proc.kill()
 
 
-def run_single_ring(n, initial_p, k):
+def node_arguments(
+    initial_p,
+    k,
+    pacing=DEFAULT_PACING,
+    channels=None,
+    control=None,
+    tokens=1,
+    loop=None,
+    log_level=None,
+    rcvbuf=None,
+    sndbuf=None,
+    transport=None,
+    transport_dir=None,
+    metrics_port=None,
+    profile=None,
+    profile_dir=None,
+    coordinated=False,
+):
+    # Options shared by every node, whichever way the ring is hosted
+    arguments = [
+        "--initial_p",
+        str(initial_p),
+        "--k",
+        str(k),
+        "--pacing",
+        str(pacing),
+        "--tokens",
+        str(tokens),
+    ]
+    for name, value in (channels or DEFAULT_CHANNELS).items():
+        arguments.extend([f"--{name}", str(value)])
+    if control:
+        arguments.extend(["--control", f"{control[0]}:{control[1]}"])
+    if loop:
+        arguments.extend(["--loop", loop])  # asyncio nodes have their own loop
+    if log_level:
+        arguments.extend(["--log_level", log_level])
+    if rcvbuf:
+        arguments.extend(["--rcvbuf", str(rcvbuf)])
+    if sndbuf:
+        arguments.extend(["--sndbuf", str(sndbuf)])
+    if transport:
+        arguments.extend(["--transport", transport])
+    if transport_dir:
+        arguments.extend(["--transport_dir", transport_dir])
+    if metrics_port is not None:
+        arguments.extend(["--metrics_port", str(metrics_port)])
+    if profile:
+        arguments.extend(["--profile", profile, "--profile_dir", profile_dir])
+    if coordinated:
+        arguments.append("--coordinated")
+    return arguments
+
+
+def wait_for_control(
+    control_sock, kind, expected, processes, timeout, progress=None, on_message=None
+):
+    # Block on the control socket until `expected` nodes have reported
+    # `kind`. Only wakes up without a message to notice dead processes or,
+    # through progress(), a ring that is still moving.
+    selector = selectors.DefaultSelector()
+    selector.register(control_sock, selectors.EVENT_READ)
+    reported = 0
+    deadline = time.monotonic() + timeout
+    try:
+        while reported < expected:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError(
+                    f"Only {reported} of {expected} nodes reported {kind} "
+                    f"within {timeout} seconds"
+                )
+            if selector.select(min(remaining, 1.0)):
+                data, _ = control_sock.recvfrom(CONTROL_BUFFER_SIZE)
+                message = decode(data)
+                if message["type"] == kind:
+                    reported += message["count"]
+                if on_message:
+                    on_message(message)
+                continue
+
+            if progress and progress():
+                deadline = time.monotonic() + timeout
+            failed = [p.returncode for p in processes if p.poll() not in (None, 0)]
+            if failed:
+                raise RuntimeError(f"{len(failed)} node processes failed")
+            if kind == "done" and all(p.poll() is not None for p in processes):
+                break
+    finally:
+        selector.close()
+    return reported
+
+
+def ring_metrics(n, collector, reported):
+    # The runner's view of a ring while it runs: what the listener has
+    # counted so far and how many nodes reported ready and done. A ring
+    # whose round count stops moving shows up as a growing
+    # seconds_since_round.
+    registry = Registry()
+    for name, kind, help in (
+        ("nodes", "gauge", "Nodes in the ring"),
+        ("nodes_ready", "gauge", "Nodes that reported ready"),
+        ("nodes_done", "gauge", "Nodes that reported done"),
+        ("rounds_total", "counter", "Round times received"),
+        ("fireworks_total", "counter", "Fireworks received"),
+        ("lost_tokens_total", "counter", "Tokens lost and regenerated"),
+        ("decode_errors_total", "counter", "Messages the listener dropped"),
+        ("last_round_seconds", "gauge", "Duration of the latest round"),
+        ("token_rounds_total", "counter", "Round times received per token"),
+        ("seconds_since_round", "gauge", "Time since the round count moved"),
+    ):
+        registry.describe(name, kind, help)
+    last = [0, time.monotonic()]
+
+    def collect():
+        stats = collector.snapshot()
+        now = time.monotonic()
+        if stats["rounds"] != last[0]:
+            last[:] = [stats["rounds"], now]
+        yield "nodes", {}, n
+        yield "nodes_ready", {}, reported["ready"]
+        yield "nodes_done", {}, reported["done"]
+        yield "rounds_total", {}, stats["rounds"]
+        yield "fireworks_total", {}, stats["multicasts"]
+        yield "lost_tokens_total", {}, stats["lost_tokens"]
+        yield "decode_errors_total", {}, stats["errors"]
+        if stats["recent"]:
+            yield "last_round_seconds", {}, stats["recent"][-1]
+        for token_id, token in sorted(stats["per_token"].items()):
+            yield "token_rounds_total", {"token": token_id}, token["rounds"]
+        yield "seconds_since_round", {}, now - last[1]
+
+    registry.add_collector(collect)
+    return registry
+
+
+def node_argv(i, n, node_args, base_port=BASE_PORT):
+    # process.py arguments of ring node i
+    return [
+        "--id",
+        str(i),
+        "--port",
+        str(base_port + i),
+        "--next_port",
+        str(base_port + ((i + 1) % n)),
+    ] + node_args
+
+
+def start_processes(n, node_args, base_port=BASE_PORT):
+    return [
+        subprocess.Popen(
+            [sys.executable, "process.py"] + node_argv(i, n, node_args, base_port)
+        )
+        for i in range(n)
+    ]
+
+
+def start_pooled_nodes(pool, n, node_args, base_port=BASE_PORT):
+    # Same nodes as start_processes, run by warm workers of a NodePool
+    pool.grow(n)
+    return [pool.launch(node_argv(i, n, node_args, base_port)) for i in range(n)]
+
+
+def start_async_workers(n, workers, node_args, base_port=BASE_PORT):
+    # Many ring nodes per OS process, sharded across a few asyncio workers
+    return [
+        subprocess.Popen(command)
+        for command in worker_commands(n, workers, node_args, base_port)
+    ]
+
+
+def run_single_ring(
+    n,
+    initial_p,
+    k,
+    mode="process",
+    workers=1,
+    pacing=DEFAULT_PACING,
+    wire="binary",
+    base_port=BASE_PORT,
+    channels=None,
+    verbose=False,
+    tokens=1,
+    pool=None,
+    loop=DEFAULT_LOOP,
+    store=None,
+    rcvbuf=None,
+    sndbuf=None,
+    transport=DEFAULT_TRANSPORT,
+    metrics_port=None,
+    profile=None,
+    coordinator=None,
+    start_barrier=None,
+):
+    # With metrics_port the runner serves its metrics on that port and node
+    # i on metrics_port + 1 + i. A segment of a topology passes a
+    # coordinator, called with every control message, which ends its tokens,
+    # and a barrier shared with the other segments, so that all of them
+    # inject their tokens at the same time.
+    if mode == "async" and transport != DEFAULT_TRANSPORT:
+        raise ValueError(f"async workers only run the {DEFAULT_TRANSPORT} transport")
     processes = []
-    round_times = []
-    multicast_count = [0]
+    service_times = LogHistogram()
+    memory = [0]
+    dropped = [0]
+    if rcvbuf == "auto":
+        rcvbuf = auto_rcvbuf(n, tokens)
+    # The kernel caps the request at net.core.rmem_max, the nodes get this
+    effective_rcvbuf = granted_rcvbuf(rcvbuf)
+    sampler = None
+    own_pool = None
+    transport_dir = None
+    metrics_server = None
+    profile_dir = None
+    profile_path = ""
+    reported = {"ready": 0, "done": 0}
+    if mode == "pool" and pool is None:
+        pool = own_pool = NodePool(n)
 
-    stop_event = threading.Event()
-    listener = threading.Thread(
-        target=listen_for_stats, args=(stop_event, round_times, multicast_count)
-    )
-    listener.start()
+    control_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    control_sock.bind(("127.0.0.1", 0))
+
+    # Raw round times and fireworks go to the store as they arrive
+    run = None
+    if store:
+        run = store.new_run(
+            n=n,
+            initial_p=initial_p,
+            k=k,
+            pacing=str(pacing),
+            tokens=tokens,
+            mode=mode,
+            wire=wire,
+            transport=transport,
+        )
+    listener = StatsListener(
+        channels or DEFAULT_CHANNELS,
+        verbose,
+        run.write if run else None,
+        max(SOCKET_RCVBUF, rcvbuf or 0),
+    ).start()
+    collector = listener.collector
+
+    def count_reports(message):
+        if message["type"] in reported:
+            reported[message["type"]] += message["count"]
+        elif coordinator:
+            coordinator(message)
 
     try:
-        for i in range(n):
-            port = BASE_PORT + i
-            next_port = BASE_PORT + ((i + 1) % n)
-            proc = subprocess.Popen(
-                [
-                    sys.executable,
-                    "process.py",
-                    "--id",
-                    str(i),
-                    "--port",
-                    str(port),
-                    "--next_port",
-                    str(next_port),
-                    "--initial_p",
-                    str(initial_p),
-                    "--k",
-                    str(k),
-                ]
-            )
-            processes.append(proc)
+        if metrics_port is not None:
+            metrics_server = MetricsServer(
+                ring_metrics(n, collector, reported), metrics_port
+            ).start()
+        if transport != DEFAULT_TRANSPORT:
+            # Sockets and shared memory names of this ring only, segments of
+            # a topology run side by side
+            transport_dir = make_transport_dir()
+        if profile:
+            # Every node writes its own profile there when it exits, merged
+            # into one file for the run afterwards
+            profile_dir = tempfile.mkdtemp(prefix="profile-")
+            name = run.run_id if run else f"n{n}-{time.strftime('%Y%m%d-%H%M%S')}"
+            profile_path = os.path.join(PROFILE_DIR, f"{name}.folded")
+        node_args = node_arguments(
+            initial_p,
+            k,
+            pacing,
+            channels,
+            control_sock.getsockname(),
+            tokens,
+            None if mode == "async" else loop,
+            "debug" if verbose else None,
+            rcvbuf,
+            sndbuf,
+            None if transport == DEFAULT_TRANSPORT else transport,
+            transport_dir,
+            # asyncio workers serve no metrics of their own
+            None if metrics_port is None or mode == "async" else metrics_port + 1,
+            profile,
+            profile_dir,
+            coordinator is not None,
+        )
+        launched = time.perf_counter()
+        if mode == "async":
+            processes.extend(start_async_workers(n, workers, node_args, base_port))
+        elif mode == "pool":
+            processes.extend(start_pooled_nodes(pool, n, node_args, base_port))
+        else:
+            processes.extend(start_processes(n, node_args, base_port))
 
-        time.sleep(2)  # Let the ring settle
+        # Inject the token as soon as every node is bound
+        wait_for_control(
+            control_sock, "ready", n, processes, TIMEOUT_STARTUP, None, count_reports
+        )
+        startup_time = time.perf_counter() - launched
+        if start_barrier:
+            start_barrier.wait(TIMEOUT_STARTUP)
+        # Peak memory of the node processes (or the workers hosting them)
+        sampler = MemorySampler(proc.pid for proc in processes).start()
 
-        # Send first token
+        # Send the tokens, spread evenly around the ring so that they are
+        # pipelined from the start. Nodes answer in the format they receive.
+        started = time.perf_counter()
         sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        token = {"round": 0, "silent_rounds": 0, "timestamp": time.time()}
-        sock.sendto(json.dumps(token).encode(), ("localhost", BASE_PORT))
-
-        # Wait for processes to start and collect round times. If we do not get a round time in 30 seconds, we assume an error occurred
-        # and terminate the processes.
-        last_round_time_count = 0
-        last_progress_time = time.time()
-        TIMEOUT_NO_PROGRESS = 120  # seconds
-
-        while any(p.poll() is None for p in processes):
-            current_count = len(round_times)
-            if current_count > last_round_time_count:
-                last_progress_time = time.time()
-                last_round_time_count = current_count
-
-            if time.time() - last_progress_time > TIMEOUT_NO_PROGRESS:
-                raise TimeoutError(
-                    "No progress (new round_times) detected in the last 30 seconds."
-                )
+        for token_id in range(tokens):
+            token = {
+                "round": 0,
+                "silent_rounds": 0,
+                "timestamp": time.time(),
+                "token_id": token_id,
+            }
+            node = token_id * n // tokens
+            sock.sendto(encode_token(token, wire), ("localhost", base_port + node))
+        sock.close()
+
+        # Wait until every node has terminated. If no new round time shows up
+        # for TIMEOUT_NO_PROGRESS seconds, we assume an error occurred and
+        # terminate the processes.
+        last_round_time_count = [0]
+
+        def progress():
+            if collector.rounds > last_round_time_count[0]:
+                last_round_time_count[0] = collector.rounds
+                return True
+            return False
+
+        def collect(message):
+            count_reports(message)
+            if message["type"] == "histogram" and message["metric"] == "service_time":
+                service_times.merge(message["histogram"])
+            elif message["type"] == "done":
+                # Resident memory of the node, or of the worker hosting it
+                memory[0] += message.get("rss", 0)
+                dropped[0] += message.get("drops", 0)
 
-            time.sleep(1)
+        wait_for_control(
+            control_sock,
+            "done",
+            n,
+            processes,
+            TIMEOUT_NO_PROGRESS,
+            progress,
+            collect,
+        )
+        elapsed = time.perf_counter() - started
+        peak = sampler.stop()
+        # Nodes report their RSS when done, in case /proc could not be read
+        rss_total = peak["rss"] or memory[0]
+        for proc in processes:
+            proc.wait()
 
-        stop_event.set()
-        listener.join()
+        listener.stop()
 
-        if round_times:
+        stats = collector.snapshot()
+        if run:
+            run.close({"rounds": stats["rounds"], "elapsed": elapsed})
+        # Node 0 only reports full circuits, a ring can end before the
+        # first one: no round times, but a complete run all the same
+        if stats["rounds"] or reported["done"] >= n:
+            hop = percentiles(service_times)
             return {
+                **percentiles(stats["histogram"]),
+                "hop_p50": hop["p50"],
+                "hop_p99": hop["p99"],
                 "n": n,
-                "rounds": len(round_times),
-                "multicasts": multicast_count[0],
-                "min_time": min(round_times),
-                "max_time": max(round_times),
-                "avg_time": mean(round_times),
+                "rounds": stats["rounds"],
+                "multicasts": stats["multicasts"],
+                "lost_tokens": stats["lost_tokens"],
+                "min_time": stats["min_time"],
+                "max_time": stats["max_time"],
+                "avg_time": stats["avg_time"],
+                "pacing": str(pacing),
+                "initial_p": initial_p,
+                "k": k,
+                "tokens": tokens,
+                "loop": "async" if mode == "async" else loop,
+                "transport": transport,
+                "profile": profile_path,
+                "rounds_per_sec": stats["rounds"] / elapsed,
+                "startup_time": startup_time,
+                "rss_per_node": rss_total // n,
+                "uss_per_node": peak["uss"] // n,
+                "rss_total": rss_total,
+                "uss_total": peak["uss"],
+                # Datagrams the kernel dropped at the nodes and the listener
+                "dropped": dropped[0] + listener.dropped,
+                "rcvbuf": effective_rcvbuf,
+                "run_id": run.run_id if run else "",
+                "per_token": [
+                    {
+                        "token": token_id,
+                        "rounds": token["rounds"],
+                        "avg_time": token["avg_time"],
+                        **percentiles(token["histogram"]),
+                    }
+                    for token_id, token in sorted(stats["per_token"].items())
+                ],
             }
         else:
             return None
 
     finally:
+        if start_barrier:
+            # Segments still waiting give up if this one failed to start
+            start_barrier.abort()
+        if sampler:
+            sampler.stop()
         cleanup_processes(processes)
-        stop_event.set()
-        listener.join()
+        if metrics_server:
+            metrics_server.stop()
+        listener.stop()
+        if run:
+            run.close({"failed": True})  # no-op if the run completed
+        control_sock.close()
+        if own_pool:
+            own_pool.close()
+        if transport_dir:
+            shutil.rmtree(transport_dir, ignore_errors=True)
+        if profile_dir:
+            merge_directory(profile_dir, profile_path)
+            shutil.rmtree(profile_dir, ignore_errors=True)
+
+
+def run_topology(
+    n,
+    initial_p,
+    k,
+    topology,
+    mode="process",
+    workers=1,
+    pacing=DEFAULT_PACING,
+    wire="binary",
+    base_port=BASE_PORT,
+    verbose=False,
+    pool=None,
+    store=None,
+    rcvbuf=None,
+    sndbuf=None,
+    transport=DEFAULT_TRANSPORT,
+    metrics_port=None,
+    profile=None,
+    tokens=1,
+    loop=DEFAULT_LOOP,
+):
+    # A ring-of-rings: runs every segment as a ring of its own, side by side,
+    # with the coordinator ending them together, and returns one row per
+    # segment plus the topology level, or None if a segment did not finish
+    placement = list(shard(n, topology.segments))
+    coordinator = Coordinator(placement, base_port, k, wire)
+    barrier = threading.Barrier(len(placement))
+    with ThreadPoolExecutor(max_workers=len(placement)) as executor:
+        futures = [
+            executor.submit(
+                run_single_ring,
+                size,
+                initial_p,
+                k,
+                mode,
+                workers,
+                pacing,
+                wire,
+                base_port + first,
+                segment_channels(index),
+                verbose,
+                tokens,
+                pool,
+                loop,
+                store,
+                rcvbuf=rcvbuf,
+                sndbuf=sndbuf,
+                transport=transport,
+                # Segment i's runner and nodes right after those of i - 1
+                metrics_port=(
+                    None if metrics_port is None else metrics_port + first + index
+                ),
+                profile=profile,
+                coordinator=partial(coordinator.report, index),
+                start_barrier=barrier,
+            )
+            for index, (first, size) in enumerate(placement)
+        ]
+        try:
+            segments = [future.result() for future in futures]
+        finally:
+            coordinator.close()
+    if not all(segments):
+        return None
+    sizes = [size for _, size in placement]
+    return level_rows(
+        n, topology, list(zip(sizes, segments)), pacing, initial_p, k, tokens
+    )
+
+
+def format_result(stats):
+    row = dict(stats)
+    for key in ("min_time", "max_time", "avg_time"):
+        if stats.get(key) not in (None, ""):
+            row[key] = f"{stats[key]:.6f}"
+    # Tail percentiles are often in the microseconds
+    for key in ("p50", "p90", "p99", "p999", "hop_p50", "hop_p99"):
+        if stats.get(key) not in (None, ""):
+            row[key] = f"{stats[key]:.9f}"
+    if "rounds_per_sec" in stats:
+        row["rounds_per_sec"] = f"{stats['rounds_per_sec']:.3f}"
+    if "startup_time" in stats:
+        row["startup_time"] = f"{stats['startup_time']:.6f}"
+    return row
+
 
+def token_results(stats):
+    # One row per token of a multi-token run
+    shared = {key: stats[key] for key in ("n", "tokens", "pacing", "initial_p", "k")}
+    return [format_result({**shared, **token}) for token in stats["per_token"]]
 
-def run_experiments(max_n=250, initial_p=0.5, k=5, step=50):
+
+def append_results(results, fieldnames=CSV_FIELDS, csv_file=CSV_FILE, delimiter=";"):
+    # Older result files may predate some columns. Rewrite them once with the
+    # current header, leaving the new columns empty for the old rows.
+    rows = []
+    if os.path.exists(csv_file) and os.stat(csv_file).st_size > 0:
+        with open(csv_file, newline="") as csvfile:
+            reader = csv.DictReader(csvfile, delimiter=delimiter)
+            if reader.fieldnames != fieldnames:
+                rows = list(reader)
+            else:
+                rows = None
+
+    mode = "a" if rows is None else "w"
+    with open(csv_file, mode=mode, newline="") as csvfile:
+        writer = csv.DictWriter(
+            csvfile, fieldnames=fieldnames, delimiter=delimiter, restval=""
+        )
+        if rows is not None:
+            writer.writeheader()
+            for row in rows:
+                writer.writerow({key: row.get(key, "") for key in fieldnames})
+        for result in results:
+            writer.writerow({key: result.get(key, "") for key in fieldnames})
+
+
+def run_experiments(
+    max_n=250,
+    initial_p=0.5,
+    k=5,
+    step=50,
+    mode="process",
+    workers=1,
+    pacing=DEFAULT_PACING,
+    wire="binary",
+    verbose=False,
+    tokens=1,
+    start_method=DEFAULT_START_METHOD,
+    loop=DEFAULT_LOOP,
+    store_dir=STORE_DIR,
+    topology=None,
+    rcvbuf=None,
+    sndbuf=None,
+    transport=DEFAULT_TRANSPORT,
+    metrics_port=None,
+    profile=None,
+):
     results = []
+    topology_rows = []
+    store = ResultStore(store_dir) if store_dir else None
+    token_rows = []
+    # One pool for the whole series, its workers are reused by every ring
+    pool = NodePool(max_n, start_method) if mode == "pool" else None
     for n in range(94, max_n + 1, step):
         print(f"\nRunning experiment with n={n}...")
         try:
-            stats = run_single_ring(n, initial_p, k)
+            if topology and topology.segments > 1:
+                rows = run_topology(
+                    n,
+                    initial_p,
+                    k,
+                    topology,
+                    mode,
+                    workers,
+                    pacing,
+                    wire,
+                    verbose=verbose,
+                    pool=pool,
+                    store=store,
+                    rcvbuf=rcvbuf,
+                    sndbuf=sndbuf,
+                    transport=transport,
+                    metrics_port=metrics_port,
+                    profile=profile,
+                    tokens=tokens,
+                    loop=loop,
+                )
+                if not rows:
+                    print(f"Failed to collect stats for n={n}.")
+                    break
+                print(f"Success: {rows[-1]}")
+                topology_rows.extend(rows)
+                continue
+            stats = run_single_ring(
+                n,
+                initial_p,
+                k,
+                mode,
+                workers,
+                pacing,
+                wire,
+                verbose=verbose,
+                tokens=tokens,
+                pool=pool,
+                loop=loop,
+                store=store,
+                rcvbuf=rcvbuf,
+                sndbuf=sndbuf,
+                transport=transport,
+                metrics_port=metrics_port,
+                profile=profile,
+            )
             if stats:
                 print(f"Success: {stats}")
-                results.append(
-                    {
-                        "n": stats["n"],
-                        "rounds": stats["rounds"],
-                        "multicasts": stats["multicasts"],
-                        "min_time": f"{stats['min_time']:.6f}",
-                        "max_time": f"{stats['max_time']:.6f}",
-                        "avg_time": f"{stats['avg_time']:.6f}",
-                    }
-                )
+                results.append(format_result(stats))
+                token_rows.extend(token_results(stats))
             else:
                 print(f"Failed to collect stats for n={n}.")
                 break
         except Exception as e:
             print(f"Error at n={n}: {e}")
             break
+    if pool:
+        pool.close()
+
+    if topology_rows:
+        append_results(
+            [format_result(row) for row in topology_rows],
+            TOPOLOGY_CSV_FIELDS,
+            TOPOLOGY_CSV_FILE,
+        )
+        results = [row for row in topology_rows if row["level"] == "topology"]
 
     print("\nFinal Results:")
     for r in results:
@@ -189,26 +762,118 @@ def run_experiments(max_n=250, initial_p=0.5, k=5, step=50):
     max_success_n = results[-1]["n"] if results else 1
     print(f"\nMaximum successful n: {max_success_n}")
 
-    fieldnames = ["n", "rounds", "multicasts", "min_time", "max_time", "avg_time"]
-    file_exists = os.path.exists(CSV_FILE)
-    write_header = not file_exists or os.stat(CSV_FILE).st_size == 0
-
-    with open(CSV_FILE, mode="a", newline="") as csvfile:
-        writer = csv.DictWriter(csvfile, fieldnames=fieldnames, delimiter=";")
-        if write_header:
-            writer.writeheader()
-        for result in results:
-            writer.writerow(
-                {
-                    "n": result["n"],
-                    "rounds": result["rounds"],
-                    "multicasts": result["multicasts"],
-                    "min_time": result["min_time"],
-                    "max_time": result["max_time"],
-                    "avg_time": result["avg_time"],
-                }
-            )
+    if not topology_rows:
+        append_results(results)
+    if tokens > 1:
+        append_results(token_rows, TOKEN_CSV_FIELDS, TOKEN_CSV_FILE)
 
 
 if __name__ == "__main__":
-    run_experiments()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--max_n", type=int, default=250)
+    parser.add_argument("--initial_p", type=float, default=0.5)
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--step", type=int, default=50)
+    add_mode_argument(parser)
+    parser.add_argument(
+        "--start_method",
+        choices=START_METHODS,
+        default=DEFAULT_START_METHOD,
+        help="How the pool forks its workers in pool mode",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of worker processes to shard the ring across in async mode",
+    )
+    add_pacing_argument(parser)
+    parser.add_argument(
+        "--wire",
+        choices=["binary", "json"],
+        default="binary",
+        help="Format of the injected token; nodes answer in the same format",
+    )
+    parser.add_argument(
+        "--verbose",
+        action="store_true",
+        help="Print every round time and firework the listener receives, and "
+        "have the nodes trace every hop",
+    )
+    parser.add_argument(
+        "--tokens",
+        type=int,
+        default=1,
+        help=f"Tokens circulating at once, per-token stats go to {TOKEN_CSV_FILE}",
+    )
+    parser.add_argument(
+        "--loop",
+        choices=LOOPS,
+        default=DEFAULT_LOOP,
+        help="Event loop of process and pool nodes: one select loop, or a "
+        "separate firework listener thread",
+    )
+    add_store_argument(parser)
+    parser.add_argument(
+        "--topology",
+        type=parse_topology,
+        default=DEFAULT_TOPOLOGY,
+        help="ring, or segments:COUNT for a ring of COUNT independent segments; "
+        f"per-level results go to {TOPOLOGY_CSV_FILE}",
+    )
+    parser.add_argument(
+        "--rcvbuf",
+        type=parse_buffer_size,
+        default=None,
+        help="SO_RCVBUF of node sockets in bytes, or auto to fit a firework "
+        "from every node; OS default if not given",
+    )
+    parser.add_argument(
+        "--sndbuf",
+        type=int,
+        default=None,
+        help="SO_SNDBUF of node sockets in bytes, OS default if not given",
+    )
+    parser.add_argument(
+        "--transport",
+        choices=TRANSPORTS,
+        default=DEFAULT_TRANSPORT,
+        help="How process and pool nodes pass tokens and fireworks: udp, unix "
+        "sockets or shared memory",
+    )
+    parser.add_argument(
+        "--metrics_port",
+        type=int,
+        default=None,
+        help="Serve live runner metrics over HTTP on this port while a ring "
+        "runs, and those of node i on the port + 1 + i",
+    )
+    parser.add_argument(
+        "--profile",
+        choices=sorted(PROFILE_MODES),
+        default=None,
+        help="Sample every node's stack on CPU or wall time; the merged "
+        f"collapsed stacks of each run go to {PROFILE_DIR}/",
+    )
+    args = parser.parse_args()
+    run_experiments(
+        args.max_n,
+        args.initial_p,
+        args.k,
+        args.step,
+        args.mode,
+        args.workers,
+        args.pacing,
+        args.wire,
+        args.verbose,
+        args.tokens,
+        args.start_method,
+        args.loop,
+        args.store,
+        args.topology,
+        args.rcvbuf,
+        args.sndbuf,
+        args.transport,
+        args.metrics_port,
+        args.profile,
+    )
@@ -0,0 +1,102 @@
+import struct
+from array import array
+
+# HDR-style log-linear histogram for nanosecond timings. Values below
+# SUB_BUCKETS get a bucket each; above that every power of two is split
+# into SUB_BUCKETS / 2 buckets, so a recorded value is off by at most
+# 1 / SUB_BUCKETS (~3%) whatever its magnitude. The bucket array has a fixed
+# size covering all 64 bit values, recording never allocates.
+SUB_BUCKET_BITS = 5
+SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+HALF_BUCKETS = SUB_BUCKETS // 2
+BUCKET_COUNT = SUB_BUCKETS + (64 - SUB_BUCKET_BITS) * HALF_BUCKETS
+
+BUCKET = struct.Struct("!HQ")
+
+
+def bucket_index(value):
+    if value < SUB_BUCKETS:
+        return value
+    shift = value.bit_length() - SUB_BUCKET_BITS
+    return SUB_BUCKETS + (shift - 1) * HALF_BUCKETS + (value >> shift) - HALF_BUCKETS
+
+
+def bucket_value(index):
+    # Middle of the range of values that land in this bucket
+    if index < SUB_BUCKETS:
+        return index
+    shift = (index - SUB_BUCKETS) // HALF_BUCKETS + 1
+    mantissa = (index - SUB_BUCKETS) % HALF_BUCKETS + HALF_BUCKETS
+    return (mantissa << shift) + (1 << (shift - 1))
+
+
+class LogHistogram:
+    def __init__(self):
+        self.counts = array("Q", bytes(8 * BUCKET_COUNT))
+        self.count = 0
+        self.min = None
+        self.max = None
+
+    def record(self, value):
+        value = max(0, int(value))
+        self.counts[bucket_index(value)] += 1
+        self.count += 1
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        for index, count in other.buckets():
+            self.counts[index] += count
+        self.count += other.count
+        for value in (other.min, other.max):
+            if value is not None:
+                self.min = value if self.min is None else min(self.min, value)
+                self.max = value if self.max is None else max(self.max, value)
+
+    def buckets(self):
+        return [(index, count) for index, count in enumerate(self.counts) if count]
+
+    def percentile(self, q):
+        if not self.count:
+            return None
+        if q >= 100:
+            return self.max
+        rank = max(1, -(-self.count * q // 100))
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                # The exact extremes beat a bucket midpoint
+                return min(max(bucket_value(index), self.min), self.max)
+        return self.max
+
+    def to_bytes(self):
+        return b"".join(BUCKET.pack(index, count) for index, count in self.buckets())
+
+    @classmethod
+    def from_buckets(cls, buckets):
+        histogram = cls()
+        for index, count in buckets:
+            histogram.counts[index] += count
+            histogram.count += count
+            value = bucket_value(index)
+            if histogram.min is None or value < histogram.min:
+                histogram.min = value
+            if histogram.max is None or value > histogram.max:
+                histogram.max = value
+        return histogram
+
+    @classmethod
+    def from_bytes(cls, data):
+        return cls.from_buckets(BUCKET.iter_unpack(data))
+
+
+def percentiles(histogram, unit=1e9):
+    # p50/p90/p99/p999 in seconds, empty strings when nothing was recorded
+    values = {}
+    for name, q in (("p50", 50), ("p90", 90), ("p99", 99), ("p999", 99.9)):
+        value = histogram.percentile(q)
+        values[name] = "" if value is None else value / unit
+    return values
@@ -0,0 +1,229 @@
+import select
+import socket
+import threading
+import time
+from array import array
+
+from drops import set_buffer_sizes, socket_drops
+from histogram import LogHistogram
+from process import open_multicast_socket
+from wire import (
+    FIREWORK,
+    MESSAGE,
+    ROUND_TIME,
+    TOKEN,
+    TOKEN_LOST,
+    WIRE_VERSION,
+    decode,
+)
+
+RECV_BUFFER_SIZE = 2048
+RECV_BATCH = 256  # datagrams drained from one socket before looking at the others
+RECENT_ROUND_TIMES = 4096  # raw round times kept, older ones only live on in
+# the aggregates and the histogram
+SOCKET_RCVBUF = 4 * 1024 * 1024
+
+MESSAGE_KINDS = {
+    "token": TOKEN,
+    "round_time": ROUND_TIME,
+    "firework": FIREWORK,
+    "token_lost": TOKEN_LOST,
+}
+
+
+class StatsCollector:
+    # Written by the listener thread only, read by the runner at any time.
+    # The writer bumps `sequence` to an odd value while it applies a batch
+    # and back to even afterwards, so readers can take a consistent snapshot
+    # without ever blocking the listener (a seqlock).
+
+    def __init__(self, capacity=RECENT_ROUND_TIMES):
+        self.sequence = 0
+        self.counters = array("Q", bytes(8 * 8))  # per wire message type
+        self.errors = 0
+        # Nodes that regenerate a token together share an epoch, so the
+        # highest epoch per token counts the losses
+        self.lost_epochs = {}
+        self.per_token = {}  # token id -> [total time, LogHistogram]
+        self.recent = array("d", bytes(8 * capacity))
+        self.capacity = capacity
+        self.rounds = 0
+        self.total_time = 0.0
+        self.min_time = None
+        self.max_time = None
+        self.histogram = LogHistogram()
+
+    def apply(self, round_times, counts, errors, lost_epochs=None):
+        self.sequence += 1
+        for token_id, epoch in (lost_epochs or {}).items():
+            self.lost_epochs[token_id] = max(self.lost_epochs.get(token_id, 0), epoch)
+        for token_id, duration in round_times:
+            self.recent[self.rounds % self.capacity] = duration
+            self.rounds += 1
+            self.total_time += duration
+            if self.min_time is None or duration < self.min_time:
+                self.min_time = duration
+            if self.max_time is None or duration > self.max_time:
+                self.max_time = duration
+            self.histogram.record(duration * 1e9)
+            token = self.per_token.get(token_id)
+            if token is None:
+                token = self.per_token[token_id] = [0.0, LogHistogram()]
+            token[0] += duration
+            token[1].record(duration * 1e9)
+        for kind, count in enumerate(counts):
+            if count:
+                self.counters[kind] += count
+        self.errors += errors
+        self.sequence += 1
+
+    def snapshot(self):
+        while True:
+            start = self.sequence
+            if start % 2:
+                time.sleep(0)
+                continue
+            rounds = self.rounds
+            kept = min(rounds, self.capacity)
+            first = rounds - kept
+            snapshot = {
+                "rounds": rounds,
+                "multicasts": self.counters[FIREWORK],
+                "lost_tokens": sum(self.lost_epochs.values()),
+                "regenerations": self.counters[TOKEN_LOST],
+                "errors": self.errors,
+                "min_time": self.min_time,
+                "max_time": self.max_time,
+                "avg_time": self.total_time / rounds if rounds else None,
+                "recent": [
+                    self.recent[i % self.capacity] for i in range(first, rounds)
+                ],
+                "histogram": LogHistogram.from_buckets(self.histogram.buckets()),
+                "per_token": {
+                    token_id: {
+                        "rounds": histogram.count,
+                        "avg_time": total / histogram.count,
+                        "histogram": LogHistogram.from_buckets(histogram.buckets()),
+                    }
+                    for token_id, (total, histogram) in list(self.per_token.items())
+                },
+            }
+            if self.sequence == start:
+                return snapshot
+
+
+class StatsListener:
+    # Receives round times and fireworks for one ring. Sockets are drained in
+    # batches with non-blocking recv_into calls on one preallocated buffer;
+    # binary messages are decoded with a single unpack_from and only counted,
+    # nothing is printed unless verbose is set.
+
+    def __init__(self, channels, verbose=False, recorder=None, rcvbuf=SOCKET_RCVBUF):
+        self.verbose = verbose
+        self.recorder = recorder  # gets every batch of raw records, see store.py
+        self.collector = StatsCollector()
+        self.round_time_sock = open_multicast_socket(
+            channels["round_time_group"], channels["round_time_port"]
+        )
+        self.firework_sock = open_multicast_socket(
+            channels["firework_group"], channels["firework_port"]
+        )
+        for sock in (self.round_time_sock, self.firework_sock):
+            self.rcvbuf = set_buffer_sizes(sock, rcvbuf)
+            sock.setblocking(False)
+        self.wakeup, self.wakeup_listener = socket.socketpair()
+        self.buffer = bytearray(RECV_BUFFER_SIZE)
+        self.view = memoryview(self.buffer)
+        self.dropped = 0  # round times and fireworks the kernel dropped
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        if not self.stop_event.is_set():
+            self.stop_event.set()
+            self.wakeup.send(b"\0")
+        self.thread.join()
+        self.close()
+
+    def close(self):
+        if self.round_time_sock.fileno() != -1:
+            self.dropped = socket_drops(self.round_time_sock, self.firework_sock)
+        for sock in (
+            self.round_time_sock,
+            self.firework_sock,
+            self.wakeup,
+            self.wakeup_listener,
+        ):
+            sock.close()
+
+    def run(self):
+        watched = [self.round_time_sock, self.firework_sock, self.wakeup_listener]
+        while not self.stop_event.is_set():
+            ready_to_read, _, _ = select.select(watched, [], [], 1.0)
+            for ready_sock in ready_to_read:
+                if ready_sock is not self.wakeup_listener:
+                    self.drain(ready_sock, RECV_BATCH)
+        # Whatever is still queued was sent before the ring finished
+        for sock in (self.round_time_sock, self.firework_sock):
+            while self.drain(sock, RECV_BATCH) == RECV_BATCH:
+                pass
+
+    def drain(self, sock, limit):
+        round_times = []
+        counts = [0] * len(self.collector.counters)
+        errors = 0
+        lost_epochs = {}
+        records = [] if self.recorder else None
+        received = 0
+        while received < limit:
+            try:
+                size = sock.recv_into(self.buffer)
+            except BlockingIOError:
+                break
+            received += 1
+            try:
+                kind, duration, number, token_id, sender = self.parse(size)
+                counts[kind] += 1
+            except (ValueError, IndexError):
+                errors += 1
+                continue
+            if records is not None and kind != TOKEN:
+                records.append((kind, token_id, sender, number, duration or 0.0))
+            if kind == ROUND_TIME:
+                round_times.append((token_id, duration))
+                if self.verbose:
+                    print(f"Received round time: {duration}")
+            elif kind == FIREWORK and self.verbose:
+                print("Received firework")
+            elif kind == TOKEN_LOST:
+                lost_epochs[token_id] = max(lost_epochs.get(token_id, 0), number)
+                if self.verbose:
+                    # Counted either way, the run reports lost_tokens
+                    print(f"Token {token_id} lost, a node injected epoch {number}")
+        if received:
+            self.collector.apply(round_times, counts, errors, lost_epochs)
+        if records:
+            self.recorder(records)
+        return received
+
+    def parse(self, size):
+        if size == MESSAGE.size:
+            version, kind, _, token_id, sender, number, _, value = MESSAGE.unpack_from(
+                self.buffer
+            )
+            if version == WIRE_VERSION:
+                return kind, value, number, token_id, sender
+        if self.buffer[:1] == b"{":
+            message = decode(bytes(self.view[:size]))
+            return (
+                MESSAGE_KINDS.get(message["type"], 0),
+                message.get("duration"),
+                message.get("epoch", message.get("round", 0)),
+                message.get("token_id", 0),
+                message.get("sender", 0),
+            )
+        raise ValueError(f"Unexpected message of {size} bytes")
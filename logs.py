@@ -0,0 +1,73 @@
+import logging
+import queue
+import sys
+from logging.handlers import QueueHandler, QueueListener
+
+# Node logging. Records are put on a queue by the node and written out by a
+# background thread, so the token path never waits for the console, which
+# hundreds of nodes share. Below WARNING every message can be sampled down to
+# one record in N. The default level keeps the token path silent, hop by hop
+# tracing is at DEBUG.
+LOGGER_NAME = "ring"
+LOG_LEVELS = ("debug", "info", "warning", "error")
+DEFAULT_LOG_LEVEL = "warning"
+LOG_FORMAT = "%(relativeCreated)9.1f %(levelname)-7s %(message)s"
+
+log = logging.getLogger(LOGGER_NAME)
+
+
+class SampleFilter(logging.Filter):
+    # Lets the first and then every `every`-th record of each message through,
+    # counted per format string so that rare messages are not drowned out.
+    # Warnings and errors always pass.
+
+    def __init__(self, every):
+        super().__init__()
+        self.every = every
+        self.seen = {}
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        seen = self.seen.get(record.msg, 0)
+        self.seen[record.msg] = seen + 1
+        return seen % self.every == 0
+
+
+def start_logging(level=DEFAULT_LOG_LEVEL, sample=1, stream=None):
+    # Returns a function that flushes the queue and stops the writer. Pool
+    # workers run one node after another, so the previous setup is replaced.
+    for handler in list(log.handlers):
+        log.removeHandler(handler)
+    log.setLevel(level.upper())
+    log.propagate = False
+    records = queue.SimpleQueue()
+    handler = QueueHandler(records)
+    if sample > 1:
+        handler.addFilter(SampleFilter(sample))
+    output = logging.StreamHandler(stream or sys.stdout)
+    output.setFormatter(logging.Formatter(LOG_FORMAT))
+    writer = QueueListener(records, output)
+    writer.start()
+    log.addHandler(handler)
+
+    def stop():
+        log.removeHandler(handler)
+        writer.stop()
+
+    return stop
+
+
+def add_logging_arguments(parser):
+    parser.add_argument(
+        "--log_level",
+        choices=LOG_LEVELS,
+        default=DEFAULT_LOG_LEVEL,
+        help="debug traces every hop, the default only reports problems",
+    )
+    parser.add_argument(
+        "--log_sample",
+        type=int,
+        default=1,
+        help="Keep one in N records of each message below warning",
+    )
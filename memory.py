@@ -0,0 +1,76 @@
+import threading
+
+# Memory accounting for ring nodes, from /proc. RSS counts pages shared with
+# other processes (the interpreter of pool workers, libraries) in full, USS
+# only counts the pages private to the process, which is what one more node
+# actually costs. PSS splits shared pages between their users.
+SAMPLE_INTERVAL = 0.5  # seconds between two samples of all nodes
+MEMORY_FIELDS = {
+    "Rss:": "rss",
+    "Pss:": "pss",
+    "Private_Clean:": "uss",
+    "Private_Dirty:": "uss",
+}
+
+
+def resident_memory():
+    # Bytes of resident memory of this process, 0 where /proc is missing
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 0
+
+
+def memory_usage(pid="self"):
+    usage = {"rss": 0, "pss": 0, "uss": 0}
+    try:
+        with open(f"/proc/{pid}/smaps_rollup") as f:
+            for line in f:
+                name, _, rest = line.partition(" ")
+                if name in MEMORY_FIELDS:
+                    usage[MEMORY_FIELDS[name]] += int(rest.split()[0]) * 1024
+    except (OSError, ValueError):
+        pass  # the process is gone, or no /proc
+    return usage
+
+
+class MemorySampler:
+    # Samples the memory of a set of processes from a background thread and
+    # keeps the peak of the totals. Sampling from the runner keeps the nodes
+    # themselves free of any instrumentation.
+
+    def __init__(self, pids, interval=SAMPLE_INTERVAL):
+        self.pids = list(pids)
+        self.interval = interval
+        self.peak = {"rss": 0, "pss": 0, "uss": 0}
+        self.samples = 0
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.sample()
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stop_event.set()
+        self.thread.join()
+        return self.peak
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            self.sample()
+
+    def sample(self):
+        totals = {"rss": 0, "pss": 0, "uss": 0}
+        for pid in self.pids:
+            for key, value in memory_usage(pid).items():
+                totals[key] += value
+        for key, value in totals.items():
+            self.peak[key] = max(self.peak[key], value)
+        self.samples += 1
+        return totals
@@ -0,0 +1,119 @@
+import argparse
+import math
+import threading
+import urllib.request
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+# Live metrics of a node or a runner in the Prometheus text format, served
+# over HTTP on 127.0.0.1 while the ring runs. The registry holds no values:
+# collectors are functions yielding (name, labels, value) samples, called
+# from the server thread when the endpoint is scraped, so the token loop
+# only bumps the plain attributes it already keeps.
+#   curl localhost:9100/metrics      or      python metrics.py 9100
+METRICS_HOST = "127.0.0.1"
+METRICS_PREFIX = "ring"
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+SCRAPE_TIMEOUT = 5
+
+
+def format_value(value):
+    if isinstance(value, int):
+        return str(value)
+    if math.isnan(value):
+        return "NaN"
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value))
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    pairs = ",".join(f'{key}="{escape(value)}"' for key, value in labels.items())
+    return "{" + pairs + "}"
+
+
+class Registry:
+    def __init__(self, **labels):
+        self.labels = labels  # on every sample, e.g. the node id
+        self.metrics = {}  # name -> (type, help)
+        self.collectors = []
+
+    def describe(self, name, kind, help):
+        self.metrics[name] = (kind, help)
+
+    def add_collector(self, collect):
+        self.collectors.append(collect)
+
+    def render(self):
+        samples = {}
+        for collect in self.collectors:
+            for name, labels, value in collect():
+                samples.setdefault(name, []).append((labels, value))
+        lines = []
+        for name, values in samples.items():
+            full_name = f"{METRICS_PREFIX}_{name}"
+            kind, help = self.metrics.get(name, ("untyped", ""))
+            if help:
+                lines.append(f"# HELP {full_name} {help}")
+            lines.append(f"# TYPE {full_name} {kind}")
+            for labels, value in values:
+                labels = format_labels({**self.labels, **labels})
+                lines.append(f"{full_name}{labels} {format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = self.server.registry.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # one line per scrape would drown the node's own log
+
+
+class MetricsServer(HTTPServer):
+    # One scrape at a time on a daemon thread, the ring never waits for it
+
+    def __init__(self, registry, port, host=METRICS_HOST):
+        super().__init__((host, port), MetricsHandler)
+        self.registry = registry
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        if self.thread:
+            self.shutdown()
+            self.thread.join()
+            self.thread = None
+        self.server_close()
+
+
+def scrape(port, host=METRICS_HOST):
+    url = f"http://{host}:{port}/metrics"
+    with urllib.request.urlopen(url, timeout=SCRAPE_TIMEOUT) as response:
+        return response.read().decode()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Print the metrics of endpoints")
+    parser.add_argument("ports", type=int, nargs="+")
+    parser.add_argument("--host", type=str, default=METRICS_HOST)
+    args = parser.parse_args()
+    for port in args.ports:
+        print(scrape(port, args.host), end="")
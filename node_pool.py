@@ -0,0 +1,122 @@
+import multiprocessing
+import os
+import subprocess
+import threading
+
+import process
+from logs import log
+
+# Warm processes that run one ring node after another. Workers are forked
+# from a forkserver that has already imported process.py, so starting a
+# node costs a fork and a pipe message instead of an interpreter start,
+# argparse and all imports. The pages of the preloaded interpreter stay
+# shared between workers until they are written to.
+START_METHODS = ("forkserver", "fork")
+DEFAULT_START_METHOD = "forkserver"
+
+
+def pool_worker(conn):
+    # Receives the argv of one node at a time, None to stop
+    parser = process.build_parser()
+    while True:
+        try:
+            argv = conn.recv()
+        except EOFError:
+            break
+        if argv is None:
+            break
+        try:
+            process.main(parser.parse_args(argv))
+            conn.send(0)
+        except BaseException as e:  # argparse exits with SystemExit
+            log.error("[Pool %s] Node failed: %r", os.getpid(), e)
+            conn.send(1)
+
+
+class PoolWorker:
+    def __init__(self, context):
+        self.conn, child = context.Pipe()
+        self.process = context.Process(target=pool_worker, args=(child,), daemon=True)
+        self.process.start()
+        child.close()
+
+
+class PooledNode:
+    # Popen-like handle of a node running in a pool worker, so the runners
+    # can wait for and clean up pooled nodes like subprocesses
+
+    def __init__(self, pool, worker, argv):
+        self.pool = pool
+        self.worker = worker
+        self.args = argv
+        self.returncode = None
+
+    @property
+    def pid(self):
+        return self.worker.process.pid
+
+    def poll(self):
+        if self.returncode is None and self.worker.conn.poll():
+            try:
+                self.returncode = self.worker.conn.recv()
+                self.pool.release(self.worker)
+            except EOFError:
+                self.returncode = -1  # the worker itself died
+                self.pool.discard(self.worker)
+        return self.returncode
+
+    def wait(self, timeout=None):
+        if self.returncode is None and not self.worker.conn.poll(timeout):
+            raise subprocess.TimeoutExpired(self.args, timeout)
+        return self.poll()
+
+    def terminate(self):
+        # A node cannot be stopped halfway, its worker is replaced instead
+        if self.poll() is None:
+            self.worker.process.terminate()
+
+    def kill(self):
+        if self.poll() is None:
+            self.worker.process.kill()
+
+
+class NodePool:
+    def __init__(self, size=0, start_method=DEFAULT_START_METHOD):
+        self.context = multiprocessing.get_context(start_method)
+        if start_method == "forkserver":
+            self.context.set_forkserver_preload(["process"])
+        self.idle = []
+        self.lock = threading.Lock()  # sweeps launch rings from several threads
+        self.grow(size)
+
+    def grow(self, size):
+        with self.lock:
+            missing = size - len(self.idle)
+        workers = [PoolWorker(self.context) for _ in range(missing)]
+        with self.lock:
+            self.idle.extend(workers)
+
+    def launch(self, argv):
+        with self.lock:
+            worker = self.idle.pop() if self.idle else None
+        if worker is None:
+            worker = PoolWorker(self.context)
+        worker.conn.send(argv)
+        return PooledNode(self, worker, argv)
+
+    def release(self, worker):
+        with self.lock:
+            self.idle.append(worker)
+
+    def discard(self, worker):
+        worker.conn.close()
+        worker.process.join()
+
+    def close(self):
+        with self.lock:
+            workers, self.idle = self.idle, []
+        for worker in workers:
+            worker.conn.send(None)
+        for worker in workers:
+            worker.process.join()
+            worker.conn.close()
@@ -0,0 +1,321 @@
+import argparse
+import json
+import socket
+import time
+
+from agent import AGENT_PORT
+from async_ring import shard
+from experiment_runner import (
+    DEFAULT_CHANNELS,
+    TIMEOUT_NO_PROGRESS,
+    TIMEOUT_STARTUP,
+    append_results,
+    format_result,
+    node_arguments,
+    node_argv,
+    wait_for_control,
+)
+from histogram import LogHistogram, percentiles
+from listener import StatsListener
+from pacing import DEFAULT_PACING, add_pacing_argument
+from store import ResultStore, add_store_argument
+from wire import encode_token
+
+# Runs one ring across the hosts of several agents (agent.py). Before the
+# run every agent's clock is compared to ours with NTP-style pings; the nodes
+# are then spread over the agents in contiguous blocks, so the token only
+# crosses a host boundary once per agent and round.
+#
+# Round times are taken by node 0 on its own perf_counter, one clock only,
+# and only for full circuits, so no measurement depends on the offsets.
+# Offsets and round trip times are only reported, in the results and the
+# run's catalog entry, to judge how far apart the hosts were.
+ORCHESTRATOR_BASE_PORT = 6000
+CALIBRATION_PINGS = 16
+AGENT_TIMEOUT = 10  # seconds for an agent to answer a request
+CSV_FILE = "orchestrated_results.csv"
+CSV_FIELDS = [
+    "n",
+    "hosts",
+    "rounds",
+    "multicasts",
+    "min_time",
+    "max_time",
+    "avg_time",
+    "pacing",
+    "initial_p",
+    "k",
+    "p50",
+    "p90",
+    "p99",
+    "p999",
+    "hop_p50",
+    "hop_p99",
+    "lost_tokens",
+    "tokens",
+    "rounds_per_sec",
+    "startup_time",
+    "max_link_offset",
+    "max_rtt",
+    "run_id",
+]
+
+
+class AgentClient:
+    def __init__(self, address):
+        self.host, self.port = address
+        self.sock = socket.create_connection(address, timeout=AGENT_TIMEOUT)
+        self.file = self.sock.makefile("rwb")
+        self.offset = 0.0  # the agent's clock minus ours
+        self.rtt = None
+
+    def request(self, command, **fields):
+        self.file.write(json.dumps({"command": command, **fields}).encode() + b"\n")
+        self.file.flush()
+        reply = json.loads(self.file.readline())
+        if "error" in reply:
+            raise RuntimeError(f"Agent {self.host}: {reply['error']}")
+        return reply
+
+    def calibrate(self, pings=CALIBRATION_PINGS):
+        # t0 we send, t1 the agent receives, t2 it answers, t3 we receive.
+        # The ping with the shortest round trip was delayed least by
+        # queueing, its offset estimate is the one we keep.
+        best = None
+        for _ in range(pings):
+            t0 = time.time()
+            reply = self.request("ping")
+            t3 = time.time()
+            t1, t2 = reply["received"], reply["sent"]
+            rtt = (t3 - t0) - (t2 - t1)
+            if best is None or rtt < best[0]:
+                best = (rtt, ((t1 - t0) + (t2 - t3)) / 2)
+        self.rtt, self.offset = best
+        return best
+
+    def local_address(self):
+        # Our address on the route to this agent, reachable for its nodes
+        return self.sock.getsockname()[0]
+
+    def close(self):
+        self.file.close()
+        self.sock.close()
+
+
+class RemoteNodes:
+    # Popen-like view of all nodes of one agent, for wait_for_control
+
+    def __init__(self, agent):
+        self.agent = agent
+        self.returncode = None
+
+    def poll(self):
+        if self.returncode is None:
+            status = self.agent.request("status")
+            if not status["running"]:
+                self.returncode = max(status["returncodes"], key=abs, default=0)
+        return self.returncode
+
+
+def parse_agent(value):
+    host, _, port = value.partition(":")
+    return socket.gethostbyname(host), int(port) if port else AGENT_PORT
+
+
+def assign_ring(agents, n):
+    # The agent hosting each node, in ring order
+    placement = []
+    for agent, (_, count) in zip(agents, shard(n, len(agents))):
+        placement.extend([agent] * count)
+    return placement
+
+
+def link_offsets(placement):
+    # Clock offset between the two hosts of every host-crossing link
+    offsets = []
+    for i, agent in enumerate(placement):
+        after = placement[(i + 1) % len(placement)]
+        if after is not agent:
+            offsets.append(after.offset - agent.offset)
+    return offsets
+
+
+def run_ring(
+    agents,
+    n,
+    initial_p,
+    k,
+    pacing=DEFAULT_PACING,
+    wire="binary",
+    tokens=1,
+    base_port=ORCHESTRATOR_BASE_PORT,
+    channels=None,
+    store=None,
+    pings=CALIBRATION_PINGS,
+):
+    channels = channels or DEFAULT_CHANNELS
+    service_times = LogHistogram()
+    for agent in agents:
+        rtt, offset = agent.calibrate(pings)
+        print(
+            f"[Orchestrator] {agent.host}: offset {offset * 1e3:+.3f} ms, "
+            f"rtt {rtt * 1e3:.3f} ms"
+        )
+    placement = assign_ring(agents, n)
+    offsets = link_offsets(placement)
+
+    control_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    control_sock.bind(("0.0.0.0", 0))
+    control_port = control_sock.getsockname()[1]
+
+    run = None
+    if store:
+        run = store.new_run(
+            n=n,
+            initial_p=initial_p,
+            k=k,
+            pacing=str(pacing),
+            tokens=tokens,
+            wire=wire,
+            hosts=[agent.host for agent in agents],
+            offsets=[agent.offset for agent in agents],
+            rtts=[agent.rtt for agent in agents],
+        )
+    listener = StatsListener(channels, False, run.write if run else None).start()
+    collector = listener.collector
+    try:
+        launched = time.perf_counter()
+        for agent in agents:
+            # Our address on the route to this agent, which may be another
+            # interface for every agent
+            control = (agent.local_address(), control_port)
+            node_args = node_arguments(initial_p, k, pacing, channels, control, tokens)
+            nodes = [
+                node_argv(i, n, node_args, base_port)
+                + ["--next_host", placement[(i + 1) % n].host]
+                for i in range(n)
+                if placement[i] is agent
+            ]
+            agent.request("start", nodes=nodes)
+        remote = [RemoteNodes(agent) for agent in agents]
+        wait_for_control(control_sock, "ready", n, remote, TIMEOUT_STARTUP)
+        startup_time = time.perf_counter() - launched
+
+        started = time.perf_counter()
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        for token_id in range(tokens):
+            node = token_id * n // tokens
+            agent = placement[node]
+            token = {
+                "round": 0,
+                "silent_rounds": 0,
+                "timestamp": time.time(),
+                "token_id": token_id,
+            }
+            sock.sendto(encode_token(token, wire), (agent.host, base_port + node))
+        sock.close()
+
+        last_round_time_count = [0]
+
+        def progress():
+            if collector.rounds > last_round_time_count[0]:
+                last_round_time_count[0] = collector.rounds
+                return True
+            return False
+
+        def collect(message):
+            if message["type"] == "histogram" and message["metric"] == "service_time":
+                service_times.merge(message["histogram"])
+
+        done = wait_for_control(
+            control_sock, "done", n, remote, TIMEOUT_NO_PROGRESS, progress, collect
+        )
+        elapsed = time.perf_counter() - started
+        listener.stop()
+
+        stats = collector.snapshot()
+        if run:
+            run.close({"rounds": stats["rounds"], "elapsed": elapsed})
+        # A ring may end before node 0 timed a full circuit, see run_single_ring
+        if not stats["rounds"] and done < n:
+            return None
+        hop = percentiles(service_times)
+        return {
+            **percentiles(stats["histogram"]),
+            "hop_p50": hop["p50"],
+            "hop_p99": hop["p99"],
+            "n": n,
+            "hosts": len(agents),
+            "rounds": stats["rounds"],
+            "multicasts": stats["multicasts"],
+            "lost_tokens": stats["lost_tokens"],
+            "min_time": stats["min_time"],
+            "max_time": stats["max_time"],
+            "avg_time": stats["avg_time"],
+            "pacing": str(pacing),
+            "initial_p": initial_p,
+            "k": k,
+            "tokens": tokens,
+            "rounds_per_sec": stats["rounds"] / elapsed,
+            "startup_time": startup_time,
+            "max_link_offset": max(map(abs, offsets), default=0.0),
+            "max_rtt": max(agent.rtt for agent in agents),
+            "run_id": run.run_id if run else "",
+        }
+    finally:
+        for agent in agents:
+            agent.request("stop")
+        listener.stop()
+        if run:
+            run.close({"failed": True})  # no-op if the run completed
+        control_sock.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--agents",
+        type=parse_agent,
+        nargs="+",
+        required=True,
+        help=f"HOST[:PORT] of every agent, port {AGENT_PORT} if not given",
+    )
+    parser.add_argument("--n", type=int, required=True)
+    parser.add_argument("--initial_p", type=float, default=0.5)
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--tokens", type=int, default=1)
+    add_pacing_argument(parser)
+    parser.add_argument("--wire", choices=["binary", "json"], default="binary")
+    parser.add_argument("--base_port", type=int, default=ORCHESTRATOR_BASE_PORT)
+    parser.add_argument(
+        "--pings",
+        type=int,
+        default=CALIBRATION_PINGS,
+        help="Pings per agent to estimate its clock offset",
+    )
+    parser.add_argument("--output", type=str, default=CSV_FILE)
+    add_store_argument(parser)
+    args = parser.parse_args()
+
+    agents = [AgentClient(address) for address in args.agents]
+    try:
+        stats = run_ring(
+            agents,
+            args.n,
+            args.initial_p,
+            args.k,
+            args.pacing,
+            args.wire,
+            args.tokens,
+            args.base_port,
+            store=ResultStore(args.store) if args.store else None,
+            pings=args.pings,
+        )
+    finally:
+        for agent in agents:
+            agent.close()
+    if stats:
+        print(f"[Orchestrator] {stats}")
+        append_results([format_result(stats)], CSV_FIELDS, args.output)
+    else:
+        print("[Orchestrator] No round times collected")
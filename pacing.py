@@ -0,0 +1,62 @@
+import argparse
+import time
+
+# none:        forward the token as soon as the hop's bookkeeping is done
+# fixed:SECS:  sleep a fixed delay before every forward (the old behaviour
+#              was fixed:0.1)
+# rate:HOPS:   pad every hop so the ring forwards at most HOPS tokens/s
+# max:         max throughput, forward the token first and do the firework
+#              multicast afterwards, off the token's critical path
+PACING_POLICIES = ("none", "fixed", "rate", "max")
+DEFAULT_PACING = "none"
+
+
+class Pacer:
+    def __init__(self, policy, value=None):
+        self.policy = policy
+        self.value = value
+        self.interval = 1.0 / value if policy == "rate" else 0.0
+        self.forward_first = policy == "max"
+
+    def delay(self, received_at):
+        # received_at is a time.monotonic() stamp taken when the token arrived
+        if self.policy == "fixed":
+            return self.value
+        if self.policy == "rate":
+            return max(0.0, received_at + self.interval - time.monotonic())
+        return 0.0
+
+    def __str__(self):
+        if self.value is None:
+            return self.policy
+        return f"{self.policy}:{self.value:g}"
+
+
+def parse_pacing(spec):
+    policy, _, value = spec.partition(":")
+    if policy not in PACING_POLICIES:
+        raise argparse.ArgumentTypeError(
+            f"unknown pacing policy {policy!r}, expected one of {', '.join(PACING_POLICIES)}"
+        )
+    if policy in ("fixed", "rate"):
+        try:
+            value = float(value)
+        except ValueError:
+            raise argparse.ArgumentTypeError(
+                f"pacing policy {policy!r} needs a number, e.g. {policy}:0.1"
+            )
+        if value < 0 or (policy == "rate" and value == 0):
+            raise argparse.ArgumentTypeError(f"invalid value for {policy}: {value}")
+        return Pacer(policy, value)
+    if value:
+        raise argparse.ArgumentTypeError(f"pacing policy {policy!r} takes no value")
+    return Pacer(policy)
+
+
+def add_pacing_argument(parser):
+    parser.add_argument(
+        "--pacing",
+        type=parse_pacing,
+        default=DEFAULT_PACING,
+        help="Token pacing: none, fixed:SECONDS, rate:HOPS_PER_SECOND or max",
+    )
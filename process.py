@@ -1,160 +1,673 @@
+import os
 import socket
 import argparse
-import json
+import contextlib
 import random
+import selectors
 import time
 import struct
 import threading
 
+from drops import set_buffer_sizes, socket_drops
+from histogram import LogHistogram
+from logs import add_logging_arguments, log, start_logging
+from memory import resident_memory
+from metrics import MetricsServer, Registry
+from pacing import add_pacing_argument
+from profiler import StackSampler, add_profile_arguments, write_collapsed
+from recovery import TokenGuard
+from transport import add_transport_arguments, open_transport
+from wire import (
+    DEFAULT_WIRE,
+    DONE,
+    FIREWORK,
+    READY,
+    SERVICE_TIME,
+    TOKEN,
+    WIRE_FORMATS,
+    decode,
+    encode_control,
+    encode_histogram,
+    encode_firework,
+    encode_round_time,
+    encode_silent,
+    encode_token,
+    encode_token_lost,
+    message_format,
+)
+
 MULTICAST_GROUP_FIREWORKS = "224.0.0.1"
 MULTICAST_GROUP_ROUND_TIMES = "224.1.1.1"
 MULTICAST_PORT_FIREWORKS = 5007
 MULTICAST_PORT_ROUND_TIMES = 5008
 BUFFER_SIZE = 1024
 
-ROUNDS_WITHOUT_FIREWORK = 0  # Global counter
-COUNTER_LOCK = threading.Lock()  # Thread-safe counter access
 DEFAULT_PORT = 5000
-TOKEN_TIMEOUT = 30
+TOKEN_TIMEOUT = 30  # longest wait for a token, first one included
+# "select" waits on the token and the firework socket in one thread,
+# "threaded" receives fireworks on a listener thread of its own. The
+# threaded loop is kept to benchmark one against the other.
+LOOPS = ("select", "threaded")
+DEFAULT_LOOP = "select"
+
+
+class Sender:
+    # Long-lived sending sockets for one node. Destinations are resolved once
+    # and the same two sockets are used for every hop and every firework.
+    # With a unix or shm transport, tokens and broadcasts to the other nodes
+    # go through it instead; reports to the runner stay on UDP.
+
+    __slots__ = (
+        "next_addr",
+        "firework_addr",
+        "round_time_addr",
+        "control_addr",
+        "sockets_opened",
+        "sends",
+        "unicast",
+        "multicast",
+        "transport",
+    )
+
+    def __init__(
+        self,
+        next_host,
+        next_port,
+        firework_addr=(MULTICAST_GROUP_FIREWORKS, MULTICAST_PORT_FIREWORKS),
+        round_time_addr=(MULTICAST_GROUP_ROUND_TIMES, MULTICAST_PORT_ROUND_TIMES),
+        control_addr=None,
+        sndbuf=None,
+        transport=None,
+    ):
+        self.next_addr = (socket.gethostbyname(next_host), next_port)
+        self.firework_addr = firework_addr
+        self.round_time_addr = round_time_addr
+        self.control_addr = control_addr
+        self.transport = transport
+        self.sockets_opened = 0
+        self.sends = 0
+
+        self.unicast = self.open_socket()
+        self.multicast = self.open_socket()
+        self.multicast.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 1)
+        for sock in (self.unicast, self.multicast):
+            set_buffer_sizes(sock, sndbuf=sndbuf)
+
+    def open_socket(self):
+        self.sockets_opened += 1
+        return socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+
+    def send_unicast(self, message):
+        self.sends += 1
+        if self.transport:
+            self.transport.send(message)
+        else:
+            self.unicast.sendto(message, self.next_addr)
+
+    def send_multicast(self, message, addr):
+        self.sends += 1
+        self.multicast.sendto(message, addr)
+
+    def broadcast(self, kind, token_id, message):
+        # Fireworks and terminations. The multicast always goes out, it is
+        # what the listener counts, and with UDP it is what the nodes get.
+        if self.transport:
+            self.transport.broadcast(kind, token_id, message)
+        self.send_multicast(message, self.firework_addr)
+
+    def send_control(self, message):
+        # Readiness and termination notices for the runner, if it asked
+        if self.control_addr:
+            self.unicast.sendto(message, self.control_addr)
+
+    def stats(self):
+        # sockets_opened and open_fds must stay flat no matter how many
+        # rounds the node has forwarded
+        return {
+            "sockets_opened": self.sockets_opened,
+            "sends": self.sends,
+            "open_fds": count_open_fds(),
+        }
 
+    def close(self):
+        self.unicast.close()
+        self.multicast.close()
 
-def send_token(next_host, next_port, token, process_id):
-    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+def count_open_fds():
+    try:
+        return len(os.listdir("/proc/self/fd"))
+    except OSError:
+        return -1
+
+
+class HopTracer:
+    # perf_counter_ns timing of one node's hops. Only this node's clock is
+    # involved, so the numbers stay valid when the ring spans several hosts.
+    # The service histogram may be shared by all nodes of a worker.
+
+    __slots__ = ("service", "received_ns", "last_forward_ns", "forwards")
+
+    def __init__(self, service=None):
+        self.service = service if service is not None else LogHistogram()
+        self.received_ns = None
+        self.last_forward_ns = None
+        self.forwards = 0
+
+    def received(self):
+        self.received_ns = time.perf_counter_ns()
+
+    def forwarded(self):
+        # Records the service time of this hop and returns the time since
+        # the previous forward, i.e. one full round, or None the first time
+        now = time.perf_counter_ns()
+        self.forwards += 1
+        if self.received_ns is not None:
+            self.service.record(now - self.received_ns)
+            self.received_ns = None
+        previous, self.last_forward_ns = self.last_forward_ns, now
+        return None if previous is None else now - previous
+
+
+class TokenState:
+    # What a node keeps per token. With several tokens in the ring each one
+    # runs its own firework and termination protocol; the silent counter is
+    # reset whenever a firework for this token arrives. Slots keep the
+    # per-node, per-token footprint small when a worker hosts many nodes.
+
+    __slots__ = (
+        "id",
+        "probability",
+        "silent",
+        "rounds",
+        "finished",
+        "fired",
+        "heard",
+        "stopped",
+        "tracer",
+        "guard",
+    )
+
+    def __init__(self, token_id, node_id, initial_p, service=None):
+        self.id = token_id
+        self.probability = initial_p
+        self.silent = 0
+        self.rounds = 0
+        self.finished = False
+        self.fired = 0  # fireworks sent and received, for the metrics
+        self.heard = 0
+        self.stopped = False  # the topology coordinator ended this token
+        self.tracer = HopTracer(service)
+        self.guard = TokenGuard(node_id, TOKEN_TIMEOUT, token_id)
+
+
+def token_states(tokens, node_id, initial_p, service=None):
+    return {
+        token_id: TokenState(token_id, node_id, initial_p, service)
+        for token_id in range(tokens)
+    }
+
+
+def send_token(sender, token, process_id, wire="binary", tracer=None, guard=None):
     current_time = time.time()
-    round_duration = max(0, current_time - token["timestamp"])
+    round_ns = tracer.forwarded() if tracer else None
 
-    # Only one process, the process with ID 0 sends the round time
-    if process_id == 0:
-        print(
-            f"[Process 0] Sending round time: {round_duration} for round {token['round']}"
-        )
-        message = json.dumps(
-            {
-                "type": "round_time",
-                "duration": round_duration,
-                "round": token["round"],
-                "sender": process_id,
-            }
+    # Only one process, the process with ID 0 sends the round time, once it
+    # has timed a full circuit: the first forward of a token, injected or
+    # regenerated, only closes a partial one
+    if process_id == 0 and round_ns is not None:
+        round_duration = round_ns / 1e9
+        log.debug(
+            "[Process 0] Sending round time: %s for round %s",
+            round_duration,
+            token["round"],
         )
-        sock.sendto(
-            message.encode(), (MULTICAST_GROUP_ROUND_TIMES, MULTICAST_PORT_ROUND_TIMES)
+        message = encode_round_time(
+            round_duration, token["round"], process_id, wire, token.get("token_id", 0)
         )
+        sender.send_multicast(message, sender.round_time_addr)
 
     token["timestamp"] = current_time
-    sock.sendto(json.dumps(token).encode(), (next_host, next_port))
+    sender.send_unicast(encode_token(token, wire))
+    if guard:
+        guard.forwarded(token)
 
 
-def multicast_firework(process_id, round_number):
-    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
-    sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 1)
-    message = f"Firework from {process_id} in round {round_number}"
-    sock.sendto(message.encode(), (MULTICAST_GROUP_FIREWORKS, MULTICAST_PORT_FIREWORKS))
+def regenerate_token(sender, guard, process_id, wire="binary", tracer=None):
+    # Called when the token did not come back in time. Returns False once
+    # the guard has given up on the ring.
+    token = guard.regenerate()
+    if token is None:
+        return False
+    log.warning(
+        "[Process %s] Token lost, injecting epoch %s in round %s",
+        process_id,
+        token["epoch"],
+        token["round"],
+    )
+    message = encode_token_lost(process_id, token["epoch"], wire, token["token_id"])
+    sender.send_multicast(message, sender.round_time_addr)
+    if tracer:
+        # The new epoch starts here, the previous forward was before the loss
+        tracer.last_forward_ns = None
+    send_token(sender, token, process_id, wire, tracer, guard)
+    return True
+
+
+def multicast_firework(sender, process_id, round_number, wire="binary", token_id=0):
+    message = encode_firework(process_id, round_number, wire, token_id)
+    sender.broadcast(FIREWORK, token_id, message)
+
+
+def multicast_termination(sender, token, wire="binary"):
+    # The terminating token also goes to every node at once, so that losing
+    # it on the ring does not make the rest regenerate a finished ring
+    message = encode_token(token, wire)
+    sender.broadcast(TOKEN, token.get("token_id", 0), message)
 
 
-def listen_multicast():
-    global ROUNDS_WITHOUT_FIREWORK
+def open_multicast_socket(group, port):
     sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
     sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    sock.bind(("", MULTICAST_PORT_FIREWORKS))
-    mreq = struct.pack(
-        "4sl", socket.inet_aton(MULTICAST_GROUP_FIREWORKS), socket.INADDR_ANY
-    )
+    sock.bind(("", port))
+    mreq = struct.pack("4sl", socket.inet_aton(group), socket.INADDR_ANY)
     sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
+    return sock
 
-    def receive():
-        global ROUNDS_WITHOUT_FIREWORK
-        while True:
+
+def handle_multicast(data, tokens, terminated):
+    # A firework resets the silent counter of its token, a multicast token
+    # means that token has terminated somewhere in the ring
+    try:
+        message = decode(data)
+    except ValueError:
+        return
+    log.debug("[Multicast] Received: %s", message)
+    if message["type"] == "firework":
+        state = tokens.get(message.get("token_id", 0))
+        if state:
+            state.silent = 0
+            state.heard += 1
+    elif message["type"] == "token":
+        terminated.add(message.get("token_id", 0))
+
+
+def drain_multicast(sock, tokens, terminated):
+    while True:
+        try:
             data, _ = sock.recvfrom(BUFFER_SIZE)
-            print("[Multicast] Received:", data.decode())
-            message = data.decode()
-            print("[Multicast] Received:", message)
-            if "Firework from" in message:
-                with COUNTER_LOCK:
-                    ROUNDS_WITHOUT_FIREWORK = 0
+        except BlockingIOError:
+            return
+        handle_multicast(data, tokens, terminated)
+
+
+def listen_multicast(sock, tokens, terminated, lock):
+    # The threaded loop: fireworks are handled on a thread of their own,
+    # under the lock that also guards the silent counters. Returns a
+    # function that stops the thread.
+    wakeup, wakeup_listener = socket.socketpair()
+
+    def receive():
+        with selectors.DefaultSelector() as selector:
+            selector.register(sock, selectors.EVENT_READ)
+            selector.register(wakeup_listener, selectors.EVENT_READ)
+            while True:
+                ready = [key.fileobj for key, _ in selector.select()]
+                if wakeup_listener in ready:
+                    break
+                with lock:
+                    drain_multicast(sock, tokens, terminated)
+
+    thread = threading.Thread(target=receive, daemon=True)
+    thread.start()
 
-    threading.Thread(target=receive, daemon=True).start()
+    def stop():
+        wakeup.send(b"\0")
+        thread.join()
+        wakeup.close()
+        wakeup_listener.close()
+
+    return stop
+
+
+def node_metrics(node_id, tokens, sender):
+    # Read from the metrics server thread. Torn reads are harmless, every
+    # value is a single attribute of a token state or of the sender.
+    registry = Registry(node=node_id)
+    for name, kind, help in (
+        ("tokens_forwarded_total", "counter", "Tokens this node forwarded"),
+        ("fireworks_sent_total", "counter", "Fireworks this node fired"),
+        ("fireworks_received_total", "counter", "Fireworks of other nodes heard"),
+        ("rounds_total", "counter", "Rounds of the token seen by this node"),
+        ("probability", "gauge", "Current firework probability"),
+        ("silent_rounds", "gauge", "Rounds since the last firework"),
+        ("token_held", "gauge", "1 while the token is at this node"),
+        ("seconds_since_token", "gauge", "Time since this node forwarded it"),
+        ("token_finished", "gauge", "1 once the token terminated here"),
+        ("sends_total", "counter", "Datagrams sent to other nodes"),
+        ("sockets_opened_total", "counter", "Sockets the sender has opened"),
+        ("open_fds", "gauge", "File descriptors open in the node process"),
+    ):
+        registry.describe(name, kind, help)
+
+    def collect():
+        now = time.perf_counter_ns()
+        for state in list(tokens.values()):
+            labels = {"token": state.id}
+            tracer = state.tracer
+            yield "tokens_forwarded_total", labels, tracer.forwards
+            yield "fireworks_sent_total", labels, state.fired
+            yield "fireworks_received_total", labels, state.heard
+            yield "rounds_total", labels, state.rounds
+            yield "probability", labels, state.probability
+            yield "silent_rounds", labels, state.silent
+            yield "token_held", labels, int(tracer.received_ns is not None)
+            last = tracer.last_forward_ns
+            since = (now - last) / 1e9 if last is not None else float("nan")
+            yield "seconds_since_token", labels, since
+            yield "token_finished", labels, int(state.finished)
+        stats = sender.stats()
+        yield "sends_total", {}, stats["sends"]
+        # Both stay flat while the ring runs, a climb is a leak
+        yield "sockets_opened_total", {}, stats["sockets_opened"]
+        yield "open_fds", {}, stats["open_fds"]
+
+    registry.add_collector(collect)
+    return registry
+
+
+def parse_address(value):
+    host, _, port = value.rpartition(":")
+    if not host or not port.isdigit():
+        raise argparse.ArgumentTypeError(f"expected HOST:PORT, got {value!r}")
+    return (socket.gethostbyname(host), int(port))
+
+
+def add_multicast_arguments(parser):
+    # Separate groups/ports let several rings run side by side on one host
+    parser.add_argument("--firework_group", type=str, default=MULTICAST_GROUP_FIREWORKS)
+    parser.add_argument("--firework_port", type=int, default=MULTICAST_PORT_FIREWORKS)
+    parser.add_argument(
+        "--round_time_group", type=str, default=MULTICAST_GROUP_ROUND_TIMES
+    )
+    parser.add_argument(
+        "--round_time_port", type=int, default=MULTICAST_PORT_ROUND_TIMES
+    )
+
+
+def add_buffer_arguments(parser):
+    parser.add_argument(
+        "--rcvbuf",
+        type=int,
+        default=None,
+        help="SO_RCVBUF of the token and firework sockets in bytes, OS default "
+        "if not given",
+    )
+    parser.add_argument(
+        "--sndbuf",
+        type=int,
+        default=None,
+        help="SO_SNDBUF of the sending sockets in bytes, OS default if not given",
+    )
 
 
 def main(args):
-    global ROUNDS_WITHOUT_FIREWORK
-    print(
-        f"[Process {args.id}] Starting with initial probability {args.initial_p} and k = {args.k}"
+    stop_logging = start_logging(args.log_level, args.log_sample)
+    log.info(
+        "[Process %s] Starting with initial probability %s, k = %s and pacing %s",
+        args.id,
+        args.initial_p,
+        args.k,
+        args.pacing,
     )
+    sock = None
+    sender = None
+    multicast_sock = None
+    transport = None
+    stop_listener = None
+    metrics_server = None
+    sampler = StackSampler(args.profile).start() if args.profile else None
+    selector = selectors.DefaultSelector()
+    # Only the threaded loop shares the token states between two threads
+    threaded = args.loop == "threaded"
+    lock = threading.Lock() if threaded else contextlib.nullcontext()
     try:
-        listen_multicast()
-        probability = args.initial_p
-        total_rounds = 0
+        service = LogHistogram()  # shared by the tracers of all tokens
+        tokens = token_states(args.tokens, args.id, args.initial_p, service)
+        terminated = set()  # ids of tokens whose terminating token was multicast
+        finished = 0
+
+        # In auto mode we answer in whatever format the token arrived in
+        wire = "binary" if args.wire == "auto" else args.wire
 
         port = args.port if args.port else DEFAULT_PORT
         next_port = args.next_port if args.next_port else DEFAULT_PORT
 
+        # Tokens injected from outside always arrive on the UDP socket
         sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         sock.bind(("0.0.0.0", port))  # Listen on all interfaces
-        sock.settimeout(TOKEN_TIMEOUT)  # Set a timeout for receiving tokens
+        set_buffer_sizes(sock, args.rcvbuf)
+        selector.register(sock, selectors.EVENT_READ)
+        transport = open_transport(
+            args.transport, args.transport_dir, port, next_port, args.rcvbuf
+        )
+        if transport:
+            selector.register(transport.token_sock, selectors.EVENT_READ)
+            broadcast_sock = transport.broadcast_sock
+        else:
+            multicast_sock = open_multicast_socket(
+                args.firework_group, args.firework_port
+            )
+            multicast_sock.setblocking(False)
+            set_buffer_sizes(multicast_sock, args.rcvbuf)
+            broadcast_sock = multicast_sock
+        if broadcast_sock and threaded:
+            stop_listener = listen_multicast(broadcast_sock, tokens, terminated, lock)
+        elif broadcast_sock:
+            # One thread waits on both sockets, no listener thread per node
+            selector.register(broadcast_sock, selectors.EVENT_READ)
+        sender = Sender(
+            args.next_host,
+            next_port,
+            (args.firework_group, args.firework_port),
+            (args.round_time_group, args.round_time_port),
+            args.control,
+            args.sndbuf,
+            transport,
+        )
+        if args.metrics_port is not None:
+            metrics_server = MetricsServer(
+                node_metrics(args.id, tokens, sender), args.metrics_port + args.id
+            ).start()
+        sender.send_control(encode_control(READY, args.id))
 
-        print(
-            f"[Process {args.id}] Started on port {port}, next = {next_port} sending to PC with ip-address {args.next_host}"
+        log.info(
+            "[Process %s] Started on port %s, next = %s sending to PC with ip-address %s",
+            args.id,
+            port,
+            next_port,
+            args.next_host,
         )
 
-        # We can manually start the first token by sending it to the first process
+        # We can manually start the tokens by sending them to the first process
         if args.inject_token:
-            print(f"[Process {args.id}] Injecting initial token...")
+            log.info(
+                "[Process %s] Injecting %s initial token(s)...", args.id, args.tokens
+            )
             time.sleep(1)  # Give next process time to start
-            initial_token = {
-                "id": args.id,
-                "timestamp": time.time(),
-                "round": 0,
-                "silent_rounds": 0,
-                "sender": args.id,
-            }
-            send_token(args.next_host, next_port, initial_token, args.id)
-
-        while True:
-            print(f"[Process {args.id}] Waiting to receive token...")
-            data, _ = sock.recvfrom(BUFFER_SIZE)
-            token = json.loads(data.decode())
-            print(f"[Process {args.id}] Received token in round {token['round']}")
+            for state in tokens.values():
+                initial_token = {
+                    "token_id": state.id,
+                    "timestamp": time.time(),
+                    "round": 0,
+                    "silent_rounds": 0,
+                    "sender": args.id,
+                }
+                send_token(
+                    sender, initial_token, args.id, wire, state.tracer, state.guard
+                )
+
+        while finished < args.tokens:
+            log.debug("[Process %s] Waiting to receive token...", args.id)
+            waiting = [state for state in tokens.values() if not state.finished]
+            timeout = min(state.guard.remaining() for state in waiting)
+            ready = [key.fileobj for key, _ in selector.select(timeout)]
+            # Fireworks that arrived with the token count before it
+            if broadcast_sock in ready:
+                drain_multicast(broadcast_sock, tokens, terminated)
+            if transport:
+                transport.poll(tokens, terminated)
+            if sock in ready:
+                data, _ = sock.recvfrom(BUFFER_SIZE)
+            elif transport and transport.token_sock in ready:
+                data = transport.receive()
+                if data is None:
+                    continue  # a doorbell for a token already taken
+            else:
+                for state in waiting:
+                    if state.guard.remaining() > 0:
+                        continue
+                    if state.id in terminated:
+                        log.info(
+                            "[Process %s] Token %s terminated, lost on the way.",
+                            args.id,
+                            state.id,
+                        )
+                    elif regenerate_token(
+                        sender, state.guard, args.id, wire, state.tracer
+                    ):
+                        continue
+                    else:
+                        log.error(
+                            "[Process %s] Giving up on token %s.", args.id, state.id
+                        )
+                    state.finished = True
+                    finished += 1
+                continue
+            received_at = time.monotonic()
+            if args.wire == "auto":
+                wire = message_format(data)
+            token = decode(data)
+            state = tokens.get(token.get("token_id", 0))
+            if token["type"] == "stop":
+                # Every segment of the topology is silent, the token ends at
+                # its next visit
+                if state:
+                    state.stopped = True
+                continue
+            if state is None or state.finished:
+                log.info("[Process %s] Dropping unexpected token %s", args.id, token)
+                continue
+            state.tracer.received()
+            new_epoch = state.guard.new_epoch(token)
+            if not state.guard.accept(token):
+                log.info(
+                    "[Process %s] Dropping stale token of epoch %s",
+                    args.id,
+                    token.get("epoch", 0),
+                )
+                continue
+            if new_epoch:
+                # Round times restart from the new token's stamp
+                state.tracer.last_forward_ns = None
+            log.debug(
+                "[Process %s] Received token %s in round %s",
+                args.id,
+                state.id,
+                token["round"],
+            )
             if token.get("silent_rounds") and token["silent_rounds"] >= args.k:
-                print(
-                    f"[Process {args.id}] Received token with silent rounds >= k, terminating."
+                log.info(
+                    "[Process %s] Received token %s with silent rounds >= k, terminating it.",
+                    args.id,
+                    state.id,
                 )
-                send_token(args.next_host, next_port, token, args.id)
-                break
-            total_rounds += 1
-            print(f"[Process {args.id}] Received token in round {token['round']}")
-
-            if random.random() < probability:
-                print(f"[Process {args.id}] FIREWORK!")
-                multicast_firework(args.id, token["round"])
-                with COUNTER_LOCK:
-                    ROUNDS_WITHOUT_FIREWORK = 0
+                send_token(sender, token, args.id, wire, state.tracer, state.guard)
+                state.finished = True
+                finished += 1
+                continue
+            state.rounds += 1
+
+            fired = random.random() < state.probability
+            if fired:
+                log.debug("[Process %s] FIREWORK!", args.id)
+                state.fired += 1
+                if not args.pacing.forward_first:
+                    multicast_firework(sender, args.id, token["round"], wire, state.id)
+                with lock:
+                    state.silent = 0
             else:
-                with COUNTER_LOCK:
-                    ROUNDS_WITHOUT_FIREWORK += 1
+                with lock:
+                    state.silent += 1
 
-            print(f"[Process {args.id}] silent rounds {ROUNDS_WITHOUT_FIREWORK}")
-            probability /= 2
+            log.debug("[Process %s] silent rounds %s", args.id, state.silent)
+            state.probability /= 2
             token["round"] += 1
 
-            with COUNTER_LOCK:
-                if ROUNDS_WITHOUT_FIREWORK >= args.k:
-                    print(
-                        f"[Process {args.id}] Terminating after {token['round']} rounds"
-                    )
-                    token["silent_rounds"] = ROUNDS_WITHOUT_FIREWORK
-                    send_token(args.next_host, next_port, token, args.id)
-                    break
+            with lock:
+                silent = state.silent
+            if args.coordinated and args.id == 0:
+                message = encode_silent(args.id, state.id, token["round"], silent)
+                sender.send_control(message)
+            # A coordinated segment leaves termination to the coordinator
+            if state.stopped if args.coordinated else silent >= args.k:
+                log.info(
+                    "[Process %s] Terminating token %s after %s rounds",
+                    args.id,
+                    state.id,
+                    token["round"],
+                )
+                token["silent_rounds"] = max(silent, args.k)
+                send_token(sender, token, args.id, wire, state.tracer, state.guard)
+                multicast_termination(sender, token, wire)
+                state.finished = True
+                finished += 1
+                continue
+
+            delay = args.pacing.delay(received_at)
+            if delay > 0:
+                time.sleep(delay)
+            send_token(sender, token, args.id, wire, state.tracer, state.guard)
+            if fired and args.pacing.forward_first:
+                multicast_firework(sender, args.id, token["round"] - 1, wire, state.id)
 
-            time.sleep(0.1)
-            send_token(args.next_host, next_port, token, args.id)
+        sender.send_control(encode_histogram(args.id, SERVICE_TIME, service))
+        # Fireworks or tokens the kernel dropped because a queue was full
+        if transport:
+            # Plus tokens and broadcasts lost to a full mailbox or Unix queue
+            dropped = socket_drops(sock) + transport.dropped
+        else:
+            dropped = socket_drops(sock, multicast_sock)
+        if dropped:
+            log.warning("[Process %s] %s datagrams dropped", args.id, dropped)
+        sender.send_control(
+            encode_control(DONE, args.id, rss=resident_memory(), drops=dropped)
+        )
 
     finally:
-        sock.close()
-        print(f"[Process {args.id}] Socket closed.")
+        if sampler:
+            os.makedirs(args.profile_dir, exist_ok=True)
+            path = os.path.join(args.profile_dir, f"node-{args.id}.folded")
+            write_collapsed(sampler.stop(), path)
+        if metrics_server:
+            metrics_server.stop()
+        if stop_listener:
+            stop_listener()
+        selector.close()
+        if multicast_sock:
+            multicast_sock.close()
+        if transport:
+            transport.close()
+        if sender:
+            log.info("[Process %s] Sender stats: %s", args.id, sender.stats())
+            sender.close()
+        if sock:
+            sock.close()
+        log.info("[Process %s] Socket closed.", args.id)
+        stop_logging()
 
 
-if __name__ == "__main__":
-    print("Starting process...")
+def build_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument("--id", type=int, required=True)
     parser.add_argument("--next_host", type=str, default="localhost")
@@ -162,9 +675,56 @@ if __name__ == "__main__":
     parser.add_argument("--next_port", type=int, default=None)
     parser.add_argument("--initial_p", type=float, default=0.5)
     parser.add_argument("--k", type=int, default=5)
+    parser.add_argument(
+        "--tokens",
+        type=int,
+        default=1,
+        help="Number of tokens circulating in the ring, each terminates on its own",
+    )
     parser.add_argument(
         "--inject_token",
         action="store_true",
         help="Inject the initial token into the ring",
     )
-    main(parser.parse_args())
+    add_pacing_argument(parser)
+    parser.add_argument(
+        "--wire",
+        choices=WIRE_FORMATS,
+        default=DEFAULT_WIRE,
+        help="Message format; auto answers in the format the token arrived in",
+    )
+    parser.add_argument(
+        "--loop",
+        choices=LOOPS,
+        default=DEFAULT_LOOP,
+        help="Wait for tokens and fireworks in one select loop, or receive "
+        "fireworks on a separate thread",
+    )
+    add_multicast_arguments(parser)
+    add_logging_arguments(parser)
+    add_buffer_arguments(parser)
+    add_transport_arguments(parser)
+    parser.add_argument(
+        "--metrics_port",
+        type=int,
+        default=None,
+        help="Serve live metrics over HTTP on this port plus the node id",
+    )
+    add_profile_arguments(parser)
+    parser.add_argument(
+        "--coordinated",
+        action="store_true",
+        help="Segment of a topology: node 0 reports silent rounds to --control "
+        "and tokens end when the coordinator sends STOP",
+    )
+    parser.add_argument(
+        "--control",
+        type=parse_address,
+        default=None,
+        help="HOST:PORT of the runner, notified when the node is ready and done",
+    )
+    return parser
+
+
+if __name__ == "__main__":
+    main(build_parser().parse_args())
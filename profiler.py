@@ -0,0 +1,145 @@
+import argparse
+import os
+import signal
+from collections import Counter
+
+# Sampling profiler for nodes and async workers. A timer signal interrupts
+# the main thread every PROFILE_INTERVAL seconds and the handler counts the
+# interrupted stack, nothing runs between samples. Profiles are written in
+# the collapsed stack format ("outer;inner;leaf count" per line) read by
+# flamegraph.pl, speedscope and inferno.
+#   cpu:   ITIMER_PROF, ticks on CPU time, a node blocked in select is not
+#          sampled: where the node burns CPU
+#   wall:  ITIMER_REAL, ticks on wall time: also where the node waits
+PROFILE_MODES = {
+    "cpu": (signal.ITIMER_PROF, signal.SIGPROF),
+    "wall": (signal.ITIMER_REAL, signal.SIGALRM),
+}
+PROFILE_INTERVAL = 0.005
+PROFILE_DIR = "profiles"
+
+
+class StackSampler:
+    def __init__(self, mode="cpu", interval=PROFILE_INTERVAL):
+        self.timer, self.signal = PROFILE_MODES[mode]
+        self.interval = interval
+        self.stacks = Counter()
+        self.labels = {}  # code object -> frame label, built once per function
+        self.previous = None
+
+    def label(self, code):
+        label = self.labels.get(code)
+        if label is None:
+            label = f"{os.path.basename(code.co_filename)}:{code.co_name}"
+            self.labels[code] = label
+        return label
+
+    def sample(self, signum, frame):
+        stack = []
+        while frame is not None:
+            stack.append(self.label(frame.f_code))
+            frame = frame.f_back
+        stack.reverse()
+        self.stacks[";".join(stack)] += 1
+
+    def start(self):
+        # Signal handlers can only be set from the main thread
+        self.previous = signal.signal(self.signal, self.sample)
+        signal.setitimer(self.timer, self.interval, self.interval)
+        return self
+
+    def stop(self):
+        signal.setitimer(self.timer, 0)
+        if self.previous is not None:
+            signal.signal(self.signal, self.previous)
+            self.previous = None
+        return self.stacks
+
+
+def write_collapsed(stacks, path):
+    with open(path, "w") as f:
+        for stack, count in sorted(stacks.items()):
+            f.write(f"{stack} {count}\n")
+
+
+def read_collapsed(path):
+    stacks = Counter()
+    with open(path) as f:
+        for line in f:
+            stack, _, count = line.rstrip("\n").rpartition(" ")
+            if stack and count.isdigit():
+                stacks[stack] += int(count)
+    return stacks
+
+
+def merge_profiles(paths):
+    # Identical stacks of different nodes add up
+    merged = Counter()
+    for path in paths:
+        merged.update(read_collapsed(path))
+    return merged
+
+
+def merge_directory(directory, path):
+    # The per-node profiles of one run into one file, None if no node wrote
+    # one
+    paths = [
+        os.path.join(directory, name)
+        for name in sorted(os.listdir(directory))
+        if name.endswith(".folded")
+    ]
+    if not paths:
+        return None
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    write_collapsed(merge_profiles(paths), path)
+    return path
+
+
+def top_frames(stacks, limit=20):
+    # (frame, self samples, total samples), most self samples first. A frame
+    # counts once per stack for the total, however deep it recurses.
+    own = Counter()
+    total = Counter()
+    for stack, count in stacks.items():
+        frames = stack.split(";")
+        own[frames[-1]] += count
+        for frame in set(frames):
+            total[frame] += count
+    return [(frame, count, total[frame]) for frame, count in own.most_common(limit)]
+
+
+def add_profile_arguments(parser):
+    parser.add_argument(
+        "--profile",
+        choices=sorted(PROFILE_MODES),
+        default=None,
+        help="Sample the stack on CPU or wall time and write a collapsed stack "
+        "profile at exit",
+    )
+    parser.add_argument(
+        "--profile_dir",
+        type=str,
+        default=PROFILE_DIR,
+        help="Directory the profile is written to",
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    commands = parser.add_subparsers(dest="command", required=True)
+    merge = commands.add_parser("merge", help="Merge collapsed stack files")
+    merge.add_argument("output")
+    merge.add_argument("inputs", nargs="+")
+    top = commands.add_parser("top", help="Functions with the most samples")
+    top.add_argument("profile")
+    top.add_argument("--limit", type=int, default=20)
+    args = parser.parse_args()
+
+    if args.command == "merge":
+        write_collapsed(merge_profiles(args.inputs), args.output)
+    else:
+        stacks = read_collapsed(args.profile)
+        samples = sum(stacks.values()) or 1
+        print(f"{'self':>7} {'total':>7}  function")
+        for frame, own, total in top_frames(stacks, args.limit):
+            print(f"{own / samples:7.1%} {total / samples:7.1%}  {frame}")
@@ -0,0 +1,122 @@
+import random
+import time
+
+# Token-loss detection. Every node keeps an EWMA of the time between two
+# visits of the token. When the token has not come back after LOSS_FACTOR
+# times that, the node assumes it was dropped and injects a fresh one.
+#
+# Tokens are ordered by (epoch, origin): a regenerated token carries the
+# previous epoch + 1 and the id of the node that made it (in the sender
+# field). A node drops any token older than the newest one it has seen, so
+# when several nodes regenerate at once, or a token that was only late
+# turns up after all, every copy but the newest dies at its next hop.
+#
+# The timer runs from the node's own last visit, so the node right after
+# the point of loss, which has waited longest, is normally the first to
+# fire. A random extra of up to one round spreads out the others, which
+# then mostly see the new token before their own timer runs out.
+LOSS_FACTOR = 4
+MIN_LOSS_TIMEOUT = 0.05  # seconds, below this we would fire on scheduling noise
+EWMA_WEIGHT = 0.125
+MAX_REGENERATIONS = 5  # consecutive ones without seeing a token, then give up
+
+
+def token_key(token):
+    return token.get("epoch", 0), token.get("sender", 0)
+
+
+class TokenGuard:
+    __slots__ = (
+        "id",
+        "token_id",
+        "max_timeout",
+        "epoch",
+        "origin",
+        "average",
+        "last_seen",
+        "last_round",
+        "circuit",
+        "last_forwarded",
+        "attempts",
+        "regenerations",
+        "deadline",
+    )
+
+    def __init__(self, node_id, max_timeout, token_id=0):
+        self.id = node_id
+        self.token_id = token_id
+        self.max_timeout = max_timeout  # also the wait for the very first token
+        self.epoch = 0
+        self.origin = 0
+        self.average = None
+        self.last_seen = None
+        self.last_round = None
+        self.circuit = 1  # hops per circuit, seen as the round counter's step
+        self.last_forwarded = None
+        self.attempts = 0
+        self.regenerations = 0
+        self.deadline = time.monotonic() + max_timeout
+
+    def timeout(self):
+        if self.average is None:
+            return self.max_timeout
+        # Back off on every attempt, the ring may just be slower than usual
+        timeout = max(MIN_LOSS_TIMEOUT, LOSS_FACTOR * self.average) * 2**self.attempts
+        timeout += random.uniform(0, max(MIN_LOSS_TIMEOUT, self.average))
+        return min(timeout, self.max_timeout)
+
+    def accept(self, token):
+        # False for a stale token that must be dropped, otherwise records
+        # the visit. A token that starts a new epoch is accepted as well.
+        key = token_key(token)
+        if key < (self.epoch, self.origin):
+            return False
+        now = time.monotonic()
+        same_epoch = key == (self.epoch, self.origin)
+        if same_epoch and self.last_seen is not None:
+            # Intervals across a regeneration contain the loss timeout
+            interval = now - self.last_seen
+            if self.average is None:
+                self.average = interval
+            else:
+                self.average += EWMA_WEIGHT * (interval - self.average)
+            if token["round"] > self.last_round:
+                self.circuit = token["round"] - self.last_round
+        self.epoch, self.origin = key
+        self.last_seen = now
+        self.last_round = token["round"]
+        self.attempts = 0
+        self.deadline = now + self.timeout()
+        return True
+
+    def remaining(self):
+        # Seconds until the token counts as lost
+        return max(0.0, self.deadline - time.monotonic())
+
+    def new_epoch(self, token):
+        return token_key(token) != (self.epoch, self.origin)
+
+    def forwarded(self, token):
+        self.last_forwarded = token["round"]
+
+    def regenerate(self):
+        # The replacement token, or None once we have given up on the ring
+        if self.average is None:
+            raise TimeoutError(f"No token received for {self.max_timeout} seconds")
+        if self.attempts >= MAX_REGENERATIONS:
+            return None
+        self.attempts += 1
+        self.regenerations += 1
+        self.epoch += 1
+        self.origin = self.id
+        self.last_seen = None
+        self.deadline = time.monotonic() + self.timeout()
+        round_number = (self.last_forwarded or self.last_round) + self.circuit
+        return {
+            "round": round_number,
+            "silent_rounds": 0,
+            "timestamp": time.time(),
+            "sender": self.id,
+            "epoch": self.epoch,
+            "token_id": self.token_id,
+        }
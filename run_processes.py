@@ -1,8 +1,16 @@
 import subprocess
 import time
 import argparse
+import shutil
 import sys
 
+from async_ring import worker_commands
+from experiment_runner import add_mode_argument
+from node_pool import NodePool
+from pacing import DEFAULT_PACING, add_pacing_argument
+from transport import DEFAULT_TRANSPORT, TRANSPORTS, make_transport_dir
+from wire import encode_token
+
 BASE_PORT = 6000
 
 
@@ -16,39 +24,77 @@ def cleanup_processes(processes):
     print("All processes cleaned up.")
 
 
-def run_ring(n, initial_p, k):
+def run_ring(
+    n,
+    initial_p,
+    k,
+    mode="process",
+    workers=1,
+    pacing=DEFAULT_PACING,
+    wire="binary",
+    tokens=1,
+    transport=DEFAULT_TRANSPORT,
+):
     processes = []
+    pool = None
+    transport_dir = None
     try:
-        for i in range(n):
-            port = BASE_PORT + i
-            next_port = BASE_PORT + ((i + 1) % n)
+        node_args = [
+            "--initial_p",
+            str(initial_p),
+            "--k",
+            str(k),
+            "--pacing",
+            str(pacing),
+            "--tokens",
+            str(tokens),
+        ]
+        if transport != DEFAULT_TRANSPORT and mode != "async":
+            transport_dir = make_transport_dir()
+            node_args += ["--transport", transport, "--transport_dir", transport_dir]
+        node_argvs = [
+            [
+                "--id",
+                str(i),
+                "--port",
+                str(BASE_PORT + i),
+                "--next_port",
+                str(BASE_PORT + ((i + 1) % n)),
+            ]
+            + node_args
+            for i in range(n)
+        ]
+        if mode == "async":
+            commands = worker_commands(n, workers, node_args, BASE_PORT, "python")
+        else:
+            commands = [["python", "process.py"] + argv for argv in node_argvs]
 
-            proc = subprocess.Popen(
-                [
-                    "python",
-                    "process.py",
-                    "--id",
-                    str(i),
-                    "--port",
-                    str(port),
-                    "--next_port",
-                    str(next_port),
-                    "--initial_p",
-                    str(initial_p),
-                    "--k",
-                    str(k),
-                ]
-            )
-            processes.append(proc)
+        if mode == "pool":
+            # Warm workers instead of one interpreter start per node
+            pool = NodePool(n)
+            for argv in node_argvs:
+                processes.append(pool.launch(argv))
+        else:
+            for command in commands:
+                processes.append(subprocess.Popen(command))
 
         time.sleep(1)  # Let the ring settle
 
-        # Start the first token
-        import socket, json
+        # Start the tokens spread around the ring, nodes answer in the same
+        # wire format
+        import socket
 
         sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        token = {"round": 0, "silent_rounds": 0, "timestamp": time.time()}
-        sock.sendto(json.dumps(token).encode(), ("localhost", BASE_PORT))
+        for token_id in range(tokens):
+            token = {
+                "round": 0,
+                "silent_rounds": 0,
+                "timestamp": time.time(),
+                "token_id": token_id,
+            }
+            node = token_id * n // tokens
+            sock.sendto(encode_token(token, wire), ("localhost", BASE_PORT + node))
+        sock.close()
 
         for proc in processes:
             proc.wait()
@@ -63,6 +109,10 @@ def run_ring(n, initial_p, k):
         sys.exit(1)
     finally:
         cleanup_processes(processes)
+        if pool:
+            pool.close()
+        if transport_dir:
+            shutil.rmtree(transport_dir, ignore_errors=True)
 
 
 if __name__ == "__main__":
@@ -70,6 +120,38 @@ if __name__ == "__main__":
     parser.add_argument("--n", type=int, default=4)
     parser.add_argument("--initial_p", type=float, default=0.5)
     parser.add_argument("--k", type=int, default=5)
+    add_mode_argument(parser)
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of worker processes to shard the ring across in async mode",
+    )
+    add_pacing_argument(parser)
+    parser.add_argument(
+        "--wire",
+        choices=["binary", "json"],
+        default="binary",
+        help="Format of the injected token; nodes answer in the same format",
+    )
+    parser.add_argument("--tokens", type=int, default=1)
+    parser.add_argument(
+        "--transport",
+        choices=TRANSPORTS,
+        default=DEFAULT_TRANSPORT,
+        help="How process and pool nodes pass tokens and fireworks; async "
+        "workers always use udp",
+    )
     args = parser.parse_args()
 
-    run_ring(args.n, args.initial_p, args.k)
+    run_ring(
+        args.n,
+        args.initial_p,
+        args.k,
+        args.mode,
+        args.workers,
+        args.pacing,
+        args.wire,
+        args.tokens,
+        args.transport,
+    )
@@ -0,0 +1,172 @@
+import argparse
+import itertools
+import time
+
+import numpy as np
+
+from experiment_runner import append_results, format_result
+
+CSV_FILE = "simulated_results.csv"
+
+
+class LatencyModel:
+    # Timing and loss of the simulated network, all times in seconds.
+    #   hop:            time for one token hop incl. node processing
+    #   jitter:         mean of an exponential extra delay per hop
+    #   firework_delay: time until a firework multicast reaches the others
+    #   loss:           probability that a given node misses a firework
+    # Anything with the same three methods can be passed to simulate_ring.
+
+    def __init__(self, hop=0.0002, jitter=0.0, firework_delay=0.0, loss=0.0):
+        self.hop = hop
+        self.jitter = jitter
+        self.firework_delay = firework_delay
+        self.loss = loss
+
+    def hop_times(self, rng, size):
+        if self.jitter:
+            return self.hop + rng.exponential(self.jitter, size)
+        return np.full(size, self.hop)
+
+    def firework_delays(self, rng, size):
+        if self.jitter:
+            return self.firework_delay + rng.exponential(self.jitter, size)
+        return np.full(size, self.firework_delay)
+
+    def delivered(self, rng, fireworks_seen):
+        # A node resets its counter if at least one of the fireworks that
+        # reached it since its last turn was not lost
+        if not self.loss:
+            return fireworks_seen > 0
+        all_lost = rng.random(fireworks_seen.size) < self.loss**fireworks_seen
+        return (fireworks_seen > 0) & ~all_lost
+
+
+def simulate_ring(n, initial_p, k, model=None, rng=None):
+    # Replays process.main for a ring of n nodes. Firework draws do not depend
+    # on any node state, so one circuit of the token is simulated at once:
+    # draw all n decisions, work out which fireworks reached every node
+    # between its previous and its current turn, then update all silent
+    # counters and look for the first node that reaches k.
+    model = model or LatencyModel()
+    rng = rng or np.random.default_rng()
+
+    silent = np.zeros(n, dtype=np.int64)
+    last_turn = np.full(n, -np.inf)
+    arrivals = np.empty(0)
+    now = 0.0
+    probability = initial_p
+    round_times = []
+    last_forward = None
+    hop_sample = None
+    multicasts = 0
+
+    while True:
+        hops = model.hop_times(rng, n)
+        turns = now + np.cumsum(hops)
+        if hop_sample is None:
+            # Hops are independent draws, one circuit is a fair sample
+            hop_sample = hops
+        # process 0 reports the time since its previous forward, nothing on
+        # its first forward, which only closes the circuit from the injector
+        if last_forward is not None:
+            round_times.append(turns[0] - last_forward)
+        last_forward = turns[0]
+
+        fired = rng.random(n) < probability
+        fire_times = turns[fired]
+        if fire_times.size:
+            arrivals = np.sort(
+                np.concatenate(
+                    (arrivals, fire_times + model.firework_delays(rng, fire_times.size))
+                )
+            )
+
+        seen = np.searchsorted(arrivals, turns, "right") - np.searchsorted(
+            arrivals, last_turn, "right"
+        )
+        silent[model.delivered(rng, seen)] = 0
+        silent += 1
+        silent[fired] = 0
+
+        terminating = np.flatnonzero(silent >= k)
+        if terminating.size:
+            node = terminating[0]
+            multicasts += int(np.count_nonzero(fired[: node + 1]))
+            if node != 0:
+                # process 0 still forwards the terminating token once more,
+                # a full circuit since its forward in this one
+                extra_hop = model.hop_times(rng, 1)[0]
+                round_times.append(turns[-1] + extra_hop - last_forward)
+            break
+
+        multicasts += int(np.count_nonzero(fired))
+        last_turn = turns
+        now = turns[-1]
+        probability /= 2
+        arrivals = arrivals[arrivals > turns[0]]
+
+    hop_p = np.percentile(hop_sample, [50, 99])
+    stats = {
+        "n": n,
+        "rounds": len(round_times),
+        "multicasts": multicasts,
+        "pacing": "simulated",
+        "initial_p": initial_p,
+        "k": k,
+        "hop_p50": float(hop_p[0]),
+        "hop_p99": float(hop_p[1]),
+    }
+    if not round_times:
+        # Ended at process 0's first forward, as run_single_ring reports it
+        stats.update(min_time=None, max_time=None, avg_time=None)
+        stats.update(p50="", p90="", p99="", p999="")
+        return stats
+    round_p = np.percentile(round_times, [50, 90, 99, 99.9])
+    stats.update(
+        min_time=float(min(round_times)),
+        max_time=float(max(round_times)),
+        avg_time=float(np.mean(round_times)),
+        p50=float(round_p[0]),
+        p90=float(round_p[1]),
+        p99=float(round_p[2]),
+        p999=float(round_p[3]),
+    )
+    return stats
+
+
+def run_sweep(ns, initial_ps, ks, repetitions=1, model=None, seed=None):
+    rng = np.random.default_rng(seed)
+    results = []
+    for n, initial_p, k in itertools.product(ns, initial_ps, ks):
+        for _ in range(repetitions):
+            started = time.perf_counter()
+            stats = simulate_ring(n, initial_p, k, model, rng)
+            print(
+                f"n={n} p={initial_p} k={k}: {stats['rounds']} rounds, "
+                f"{stats['multicasts']} multicasts "
+                f"({time.perf_counter() - started:.3f}s)"
+            )
+            results.append(format_result(stats))
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--n", type=int, nargs="+", default=[94, 144, 194, 244])
+    parser.add_argument("--initial_p", type=float, nargs="+", default=[0.5])
+    parser.add_argument("--k", type=int, nargs="+", default=[5])
+    parser.add_argument("--repetitions", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--hop", type=float, default=0.0002)
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--firework_delay", type=float, default=0.0)
+    parser.add_argument("--loss", type=float, default=0.0)
+    parser.add_argument("--output", type=str, default=CSV_FILE)
+    args = parser.parse_args()
+
+    model = LatencyModel(args.hop, args.jitter, args.firework_delay, args.loss)
+    results = run_sweep(
+        args.n, args.initial_p, args.k, args.repetitions, model, args.seed
+    )
+    append_results(results, csv_file=args.output)
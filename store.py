@@ -0,0 +1,179 @@
+import argparse
+import itertools
+import json
+import os
+import struct
+import threading
+import time
+
+from histogram import LogHistogram, percentiles
+from wire import FIREWORK, ROUND_TIME, TOKEN_LOST
+
+# Raw results of every ring run. Each run streams fixed-size binary records,
+# one per round time, firework and token loss the listener saw, to a file of
+# its own; record i sits at offset i * RECORD.size, so any slice of a run can
+# be read without touching the rest. The parameters of a run (n, p, k, ...)
+# are kept once per run in the catalog, runs.jsonl, which is all that has to
+# be read to pick runs. Aggregates are computed from the records on demand.
+STORE_DIR = "results"
+CATALOG = "runs.jsonl"
+RECORD = struct.Struct("<BHIId")  # kind, token, node, round, value
+READ_CHUNK = 4096  # records per read
+RECORD_KINDS = {
+    "round_time": ROUND_TIME,
+    "firework": FIREWORK,
+    "token_lost": TOKEN_LOST,
+}
+
+
+class RunWriter:
+    # Appended to by the listener thread, closed by the runner
+    def __init__(self, store, run_id, params):
+        self.store = store
+        self.run_id = run_id
+        self.params = params
+        self.records = 0
+        self.file = open(store.run_path(run_id), "ab")
+
+    def write(self, records):
+        self.file.write(b"".join(RECORD.pack(*record) for record in records))
+        self.records += len(records)
+
+    def close(self, summary=None):
+        # Only runs that made it into the catalog are listed by runs()
+        if self.file.closed:
+            return
+        self.file.close()
+        self.store.add_run(
+            {
+                "run_id": self.run_id,
+                **self.params,
+                "records": self.records,
+                **(summary or {}),
+            }
+        )
+
+
+class ResultStore:
+    def __init__(self, directory=STORE_DIR):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.lock = threading.Lock()  # sweeps finish runs from several threads
+        self.counter = itertools.count()
+
+    def run_path(self, run_id):
+        return os.path.join(self.directory, f"{run_id}.bin")
+
+    def new_run(self, **params):
+        run_id = f"{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}-{next(self.counter)}"
+        return RunWriter(self, run_id, {"started": time.time(), **params})
+
+    def add_run(self, entry):
+        line = json.dumps(entry) + "\n"
+        with self.lock:
+            with open(os.path.join(self.directory, CATALOG), "a") as f:
+                f.write(line)
+
+    def runs(self, **filters):
+        path = os.path.join(self.directory, CATALOG)
+        if not os.path.exists(path):
+            return []
+        with open(path) as f:
+            entries = [json.loads(line) for line in f if line.strip()]
+        return [
+            entry
+            for entry in entries
+            if all(entry.get(key) == value for key, value in filters.items())
+        ]
+
+    def records(self, run_id, kind=None, start=0, stop=None):
+        # Yields (kind, token, node, round, value) for records start..stop
+        with open(self.run_path(run_id), "rb") as f:
+            f.seek(start * RECORD.size)
+            remaining = None if stop is None else stop - start
+            while remaining is None or remaining > 0:
+                count = READ_CHUNK if remaining is None else min(READ_CHUNK, remaining)
+                data = f.read(count * RECORD.size)
+                usable = len(data) - len(data) % RECORD.size  # a run still written
+                if not usable:
+                    return
+                for record in RECORD.iter_unpack(data[:usable]):
+                    if kind is None or record[0] == kind:
+                        yield record
+                if remaining is not None:
+                    remaining -= usable // RECORD.size
+
+    def round_times(self, run_id, token=None):
+        for _, token_id, _, _, duration in self.records(run_id, ROUND_TIME):
+            if token is None or token_id == token:
+                yield duration
+
+    def summary(self, run_id, token=None):
+        histogram = LogHistogram()
+        rounds = 0
+        total = 0.0
+        low = high = None
+        for duration in self.round_times(run_id, token):
+            rounds += 1
+            total += duration
+            low = duration if low is None else min(low, duration)
+            high = duration if high is None else max(high, duration)
+            histogram.record(duration * 1e9)
+        return {
+            "rounds": rounds,
+            "multicasts": sum(1 for _ in self.records(run_id, FIREWORK)),
+            "min_time": low,
+            "max_time": high,
+            "avg_time": total / rounds if rounds else None,
+            **percentiles(histogram),
+        }
+
+
+def add_store_argument(parser):
+    parser.add_argument(
+        "--store",
+        type=str,
+        default=STORE_DIR,
+        help="Directory for the raw round times and fireworks of every run, "
+        "empty to keep aggregates only",
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--store", type=str, default=STORE_DIR)
+    commands = parser.add_subparsers(dest="command", required=True)
+    list_parser = commands.add_parser("list", help="List the runs in the catalog")
+    list_parser.add_argument("--n", type=int, default=None)
+    list_parser.add_argument("--k", type=int, default=None)
+    summary_parser = commands.add_parser(
+        "summary", help="Recompute the aggregates of a run from its records"
+    )
+    summary_parser.add_argument("run_id")
+    summary_parser.add_argument("--token", type=int, default=None)
+    dump_parser = commands.add_parser("dump", help="Print raw records of a run")
+    dump_parser.add_argument("run_id")
+    dump_parser.add_argument("--kind", choices=RECORD_KINDS, default=None)
+    dump_parser.add_argument("--start", type=int, default=0)
+    dump_parser.add_argument("--stop", type=int, default=None)
+    args = parser.parse_args()
+
+    store = ResultStore(args.store)
+    if args.command == "list":
+        filters = {
+            key: getattr(args, key)
+            for key in ("n", "k")
+            if getattr(args, key) is not None
+        }
+        for entry in store.runs(**filters):
+            print(
+                f"{entry['run_id']}: n={entry.get('n')} p={entry.get('initial_p')} "
+                f"k={entry.get('k')} records={entry['records']}"
+            )
+    elif args.command == "summary":
+        for key, value in store.summary(args.run_id, args.token).items():
+            print(f"{key}: {value}")
+    else:
+        kind = RECORD_KINDS.get(args.kind)
+        for record in store.records(args.run_id, kind, args.start, args.stop):
+            print(record)
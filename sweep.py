@@ -0,0 +1,487 @@
+import argparse
+import itertools
+import os
+import resource
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from benchmark import confidence_interval
+from experiment_runner import (
+    CSV_FILE,
+    TOKEN_CSV_FIELDS,
+    TOKEN_CSV_FILE,
+    add_mode_argument,
+    append_results,
+    format_result,
+    run_single_ring,
+    token_results,
+)
+from node_pool import DEFAULT_START_METHOD, START_METHODS, NodePool
+from pacing import DEFAULT_PACING, add_pacing_argument
+from store import ResultStore, add_store_argument
+
+# Every concurrently running experiment gets a slot: its own unicast port
+# range and its own multicast groups and ports, so rings never see each
+# other's tokens, fireworks or round times.
+SWEEP_BASE_PORT = 10000
+SWEEP_MULTICAST_PORT = 7000
+# Node ports stay below the kernel's ephemeral range, where the runners'
+# own sockets are bound, and the slot is an octet of the multicast groups
+EPHEMERAL_PORT_START = 32768
+MAX_SLOTS = 256
+FDS_PER_NODE = 8  # token socket, two sender sockets, multicast socket, stdio
+
+# Adaptive sweeps repeat every point until the 95% confidence interval of
+# each target metric is within TOLERANCE of its mean (half width / mean),
+# or the repetition budget is spent. Repetitions beyond the minimum run one
+# at a time, each decides whether another one is needed; they go to the
+# front of the queue, so in pool mode they find the workers of the
+# previous repetition warm. One row per point goes to POINTS_CSV_FILE.
+TARGET_METRICS = ("avg_time", "rounds", "p50", "p99", "rounds_per_sec", "multicasts")
+DEFAULT_TARGETS = ["avg_time", "rounds"]
+DEFAULT_TOLERANCE = 0.05
+DEFAULT_MIN_REPETITIONS = 3
+DEFAULT_MAX_REPETITIONS = 20
+POINTS_CSV_FILE = "sweep_points.csv"
+
+
+def slot_settings(slot, port_stride):
+    base_port = SWEEP_BASE_PORT + slot * port_stride
+    channels = {
+        "firework_group": f"239.255.{slot}.1",
+        "firework_port": SWEEP_MULTICAST_PORT + 2 * slot,
+        "round_time_group": f"239.255.{slot}.2",
+        "round_time_port": SWEEP_MULTICAST_PORT + 2 * slot + 1,
+    }
+    return base_port, channels
+
+
+def slot_count(port_stride):
+    # How many slots fit, ports and groups both
+    return min(MAX_SLOTS, (EPHEMERAL_PORT_START - SWEEP_BASE_PORT) // port_stride)
+
+
+def default_fd_budget():
+    # Leave headroom for the runner itself and for the rest of the machine
+    soft, _ = resource.getrlimit(resource.RLIMIT_NOFILE)
+    try:
+        with open("/proc/sys/fs/file-max") as f:
+            system = int(f.read())
+    except (OSError, ValueError):
+        system = soft
+    return min(system // 2, 1 << 20)
+
+
+class SweepPoint:
+    def __init__(self, n, initial_p, k, repetition, tokens=1, estimate=None):
+        self.n = n
+        self.initial_p = initial_p
+        self.k = k
+        self.repetition = repetition
+        self.tokens = tokens
+        self.estimate = estimate  # shared by the repetitions of adaptive sweeps
+        self.attempts = 0
+
+    def cost(self, mode, workers):
+        processes = self.n if mode in ("process", "pool") else min(workers, self.n)
+        return processes, self.n * FDS_PER_NODE
+
+    def __str__(self):
+        return (
+            f"n={self.n} p={self.initial_p} k={self.k} T={self.tokens} "
+            f"rep={self.repetition}"
+        )
+
+
+class PointEstimate:
+    # The repetitions of one (n, p, k, tokens) point of an adaptive sweep
+
+    def __init__(
+        self,
+        n,
+        initial_p,
+        k,
+        tokens=1,
+        targets=DEFAULT_TARGETS,
+        tolerance=DEFAULT_TOLERANCE,
+        min_repetitions=DEFAULT_MIN_REPETITIONS,
+        max_repetitions=DEFAULT_MAX_REPETITIONS,
+    ):
+        self.n = n
+        self.initial_p = initial_p
+        self.k = k
+        self.tokens = tokens
+        self.targets = targets
+        self.tolerance = tolerance
+        self.min_repetitions = min_repetitions
+        self.max_repetitions = max(min_repetitions, max_repetitions)
+        self.samples = {metric: [] for metric in targets}
+        self.completed = 0
+        self.scheduled = 0
+        self.running = 0
+        self.failed = 0
+
+    def next_repetition(self):
+        point = SweepPoint(
+            self.n, self.initial_p, self.k, self.scheduled, self.tokens, self
+        )
+        self.scheduled += 1
+        self.running += 1
+        return point
+
+    def add(self, stats):
+        self.running -= 1
+        self.completed += 1
+        for metric in self.targets:
+            # Empty for a ring that ended before a full circuit
+            if stats[metric] not in (None, ""):
+                self.samples[metric].append(float(stats[metric]))
+
+    def give_up(self):
+        self.running -= 1
+        self.failed += 1
+
+    def relative_half_width(self, metric):
+        mean, _, low, high = confidence_interval(self.samples[metric])
+        return (high - low) / 2 / abs(mean) if mean else 0.0
+
+    def converged(self):
+        return self.completed >= self.min_repetitions and all(
+            self.relative_half_width(metric) <= self.tolerance
+            for metric in self.targets
+            if self.samples[metric]
+        )
+
+    def wants_more(self):
+        return (
+            not self.running
+            and self.scheduled < self.max_repetitions
+            and not self.converged()
+        )
+
+    def complete(self):
+        return not self.running and not self.wants_more()
+
+    def fieldnames(self):
+        fields = ["n", "initial_p", "k", "tokens", "repetitions", "failed"]
+        fields.append("converged")
+        for metric in self.targets:
+            fields.extend(
+                f"{metric}_{column}"
+                for column in ("mean", "stdev", "ci_low", "ci_high", "rel_ci")
+            )
+        return fields
+
+    def row(self):
+        row = {
+            "n": self.n,
+            "initial_p": self.initial_p,
+            "k": self.k,
+            "tokens": self.tokens,
+            "repetitions": self.completed,
+            "failed": self.failed,
+            "converged": self.converged(),
+        }
+        for metric, samples in self.samples.items():
+            if not samples:
+                continue
+            mean, stdev, low, high = confidence_interval(samples)
+            row[f"{metric}_mean"] = f"{mean:.9g}"
+            row[f"{metric}_stdev"] = f"{stdev:.9g}"
+            row[f"{metric}_ci_low"] = f"{low:.9g}"
+            row[f"{metric}_ci_high"] = f"{high:.9g}"
+            row[f"{metric}_rel_ci"] = f"{self.relative_half_width(metric):.4f}"
+        return row
+
+
+class SweepScheduler:
+    def __init__(
+        self,
+        points,
+        mode="process",
+        workers=1,
+        pacing=DEFAULT_PACING,
+        wire="binary",
+        max_parallel=None,
+        cpu_budget=None,
+        fd_budget=None,
+        retries=2,
+        csv_file=CSV_FILE,
+        token_csv_file=TOKEN_CSV_FILE,
+        start_method=DEFAULT_START_METHOD,
+        store=None,
+        points_csv_file=POINTS_CSV_FILE,
+    ):
+        self.pending = list(points)
+        self.mode = mode
+        self.workers = workers
+        self.pacing = pacing
+        self.wire = wire
+        self.max_parallel = max_parallel or os.cpu_count()
+        # A ring only ever has one busy node, so a core can host several of
+        # them. The budget counts OS processes, not busy cores.
+        self.cpu_budget = cpu_budget or 64 * os.cpu_count()
+        self.fd_budget = fd_budget or default_fd_budget()
+        self.retries = retries
+        self.csv_file = csv_file
+        self.token_csv_file = token_csv_file
+        self.start_method = start_method
+        self.store = store
+        self.points_csv_file = points_csv_file
+        self.estimates = []  # points of an adaptive sweep, once complete
+        self.pool = None
+        self.port_stride = max(point.n for point in self.pending) + 1
+        slots = slot_count(self.port_stride)
+        if slots < 1:
+            raise ValueError(
+                f"A ring of {self.port_stride - 1} nodes does not fit between port "
+                f"{SWEEP_BASE_PORT} and the ephemeral range at {EPHEMERAL_PORT_START}"
+            )
+        if self.max_parallel > slots:
+            print(f"[Sweep] Only {slots} slots fit, running {slots} at a time")
+            self.max_parallel = slots
+        self.free_slots = list(range(self.max_parallel))
+        self.used_cpu = 0
+        self.used_fds = 0
+        self.results = []
+        self.failed = []
+        self.csv_lock = threading.Lock()
+
+    def fits(self, point, running):
+        cpu, fds = point.cost(self.mode, self.workers)
+        if not running:
+            # An experiment larger than the budget still runs, on its own
+            return True
+        return (
+            self.used_cpu + cpu <= self.cpu_budget
+            and self.used_fds + fds <= self.fd_budget
+        )
+
+    def run_point(self, point, slot):
+        base_port, channels = slot_settings(slot, self.port_stride)
+        stats = run_single_ring(
+            point.n,
+            point.initial_p,
+            point.k,
+            self.mode,
+            self.workers,
+            self.pacing,
+            self.wire,
+            base_port,
+            channels,
+            tokens=point.tokens,
+            pool=self.pool,
+            store=self.store,
+        )
+        if not stats:
+            raise RuntimeError("not every node finished")
+        # Stream every finished point to disk right away
+        with self.csv_lock:
+            append_results([format_result(stats)], csv_file=self.csv_file)
+            if point.tokens > 1:
+                append_results(
+                    token_results(stats), TOKEN_CSV_FIELDS, self.token_csv_file
+                )
+        return stats
+
+    def settle(self, estimate):
+        # Called after every repetition of an adaptive point
+        if estimate.wants_more():
+            # First in line, while the ring size is warm in the pool
+            self.pending.insert(0, estimate.next_repetition())
+        elif estimate.complete():
+            self.estimates.append(estimate)
+            row = estimate.row()
+            print(
+                f"[Sweep] n={estimate.n} p={estimate.initial_p} k={estimate.k} "
+                f"T={estimate.tokens}: {row['repetitions']} repetitions, "
+                f"converged {row['converged']}"
+            )
+            with self.csv_lock:
+                append_results([row], estimate.fieldnames(), self.points_csv_file)
+
+    def run(self):
+        if self.mode == "pool":
+            # Shared by all concurrent rings, workers go back to it after
+            # every experiment
+            self.pool = NodePool(0, self.start_method)
+        try:
+            return self.schedule()
+        finally:
+            if self.pool:
+                self.pool.close()
+
+    def schedule(self):
+        running = {}
+        with ThreadPoolExecutor(max_workers=self.max_parallel) as pool:
+            while self.pending or running:
+                while self.pending and self.free_slots:
+                    point = self.pending[0]
+                    if not self.fits(point, running):
+                        break
+                    self.pending.pop(0)
+                    slot = self.free_slots.pop(0)
+                    cpu, fds = point.cost(self.mode, self.workers)
+                    self.used_cpu += cpu
+                    self.used_fds += fds
+                    point.attempts += 1
+                    print(f"[Sweep] Starting {point} in slot {slot}")
+                    future = pool.submit(self.run_point, point, slot)
+                    running[future] = (point, slot)
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    point, slot = running.pop(future)
+                    cpu, fds = point.cost(self.mode, self.workers)
+                    self.used_cpu -= cpu
+                    self.used_fds -= fds
+                    self.free_slots.append(slot)
+                    try:
+                        stats = future.result()
+                        self.results.append(format_result(stats))
+                        print(f"[Sweep] Finished {point}")
+                        if point.estimate:
+                            point.estimate.add(stats)
+                            self.settle(point.estimate)
+                    except Exception as e:
+                        if point.attempts <= self.retries:
+                            print(f"[Sweep] {point} failed ({e}), retrying")
+                            self.pending.append(point)
+                        else:
+                            print(f"[Sweep] {point} failed ({e}), giving up")
+                            self.failed.append(point)
+                            if point.estimate:
+                                point.estimate.give_up()
+                                self.settle(point.estimate)
+        return self.results
+
+
+def build_grid(ns, initial_ps, ks, repetitions, tokens=(1,)):
+    return [
+        SweepPoint(n, initial_p, k, repetition, t)
+        for n, initial_p, k, t in itertools.product(ns, initial_ps, ks, tokens)
+        for repetition in range(repetitions)
+    ]
+
+
+def build_adaptive_grid(
+    ns,
+    initial_ps,
+    ks,
+    tokens=(1,),
+    targets=DEFAULT_TARGETS,
+    tolerance=DEFAULT_TOLERANCE,
+    min_repetitions=DEFAULT_MIN_REPETITIONS,
+    max_repetitions=DEFAULT_MAX_REPETITIONS,
+):
+    # The minimum repetitions of every point, back to back and by growing n
+    points = []
+    for n, initial_p, k, t in itertools.product(sorted(ns), initial_ps, ks, tokens):
+        estimate = PointEstimate(
+            n, initial_p, k, t, targets, tolerance, min_repetitions, max_repetitions
+        )
+        points.extend(estimate.next_repetition() for _ in range(min_repetitions))
+    return points
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--n", type=int, nargs="+", default=[94, 144, 194, 244])
+    parser.add_argument("--initial_p", type=float, nargs="+", default=[0.5])
+    parser.add_argument("--k", type=int, nargs="+", default=[5])
+    parser.add_argument(
+        "--tokens",
+        type=int,
+        nargs="+",
+        default=[1],
+        help="Tokens circulating at once; sweep it with n to find saturation",
+    )
+    parser.add_argument("--repetitions", type=int, default=1)
+    parser.add_argument(
+        "--adaptive",
+        action="store_true",
+        help="Repeat every point until the confidence intervals of the target "
+        f"metrics are within the tolerance; per-point results go to "
+        f"{POINTS_CSV_FILE}",
+    )
+    parser.add_argument(
+        "--target",
+        choices=TARGET_METRICS,
+        nargs="+",
+        default=DEFAULT_TARGETS,
+        help="Metrics whose confidence intervals an adaptive sweep narrows",
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=DEFAULT_TOLERANCE,
+        help="Largest half width of a 95%% confidence interval, relative to "
+        "the mean",
+    )
+    parser.add_argument("--min_repetitions", type=int, default=DEFAULT_MIN_REPETITIONS)
+    parser.add_argument("--max_repetitions", type=int, default=DEFAULT_MAX_REPETITIONS)
+    parser.add_argument("--points_output", type=str, default=POINTS_CSV_FILE)
+    add_mode_argument(parser)
+    parser.add_argument(
+        "--start_method", choices=START_METHODS, default=DEFAULT_START_METHOD
+    )
+    parser.add_argument("--workers", type=int, default=1)
+    add_pacing_argument(parser)
+    parser.add_argument("--wire", choices=["binary", "json"], default="binary")
+    parser.add_argument(
+        "--parallel", type=int, default=None, help="Experiments running at once"
+    )
+    parser.add_argument(
+        "--cpu_budget", type=int, default=None, help="Max node processes at once"
+    )
+    parser.add_argument(
+        "--fd_budget", type=int, default=None, help="Max file descriptors at once"
+    )
+    parser.add_argument("--retries", type=int, default=2)
+    parser.add_argument("--output", type=str, default=CSV_FILE)
+    add_store_argument(parser)
+    args = parser.parse_args()
+
+    started = time.time()
+    if args.adaptive:
+        points = build_adaptive_grid(
+            args.n,
+            args.initial_p,
+            args.k,
+            args.tokens,
+            args.target,
+            args.tolerance,
+            args.min_repetitions,
+            args.max_repetitions,
+        )
+    else:
+        points = build_grid(
+            args.n, args.initial_p, args.k, args.repetitions, args.tokens
+        )
+    scheduler = SweepScheduler(
+        points,
+        args.mode,
+        args.workers,
+        args.pacing,
+        args.wire,
+        args.parallel,
+        args.cpu_budget,
+        args.fd_budget,
+        args.retries,
+        args.output,
+        start_method=args.start_method,
+        store=ResultStore(args.store) if args.store else None,
+        points_csv_file=args.points_output,
+    )
+    results = scheduler.run()
+    print(
+        f"\n[Sweep] {len(results)} points done, {len(scheduler.failed)} failed, "
+        f"in {time.time() - started:.1f}s"
+    )
+    if args.adaptive:
+        converged = sum(estimate.converged() for estimate in scheduler.estimates)
+        print(
+            f"[Sweep] {converged} of {len(scheduler.estimates)} points within "
+            f"{args.tolerance:.0%}, rows in {args.points_output}"
+        )
@@ -0,0 +1,169 @@
+import argparse
+import socket
+import threading
+import time
+
+from wire import encode_stop
+
+# Ring-of-rings. "segments:S" splits the n nodes into S segments of about
+# n / S nodes. Every segment is a ring of its own: its own token, its own
+# firework and round time groups, its own silent-round count, so a round
+# only visits n / S nodes and a firework only reaches its segment.
+# The second level is the Coordinator: node 0 of every segment reports the
+# silent-round count of each token over the control channel whenever it
+# forwards it, and segments never end a token by themselves. Once every
+# segment has been silent for k rounds at the same time, the coordinator
+# stops the token in all of them together. Segments that are silent early
+# keep their token going until then, so a topology round takes as long as
+# the slowest segment's round.
+# "ring" is the flat ring, i.e. one segment.
+TOPOLOGY_KINDS = ("ring", "segments")
+DEFAULT_TOPOLOGY = "ring"
+SEGMENT_MULTICAST_PORT = 8000
+STOP_RESEND = 0.5  # seconds before a segment still reporting is stopped again
+TOPOLOGY_CSV_FILE = "topology_results.csv"
+TOPOLOGY_CSV_FIELDS = [
+    "n",
+    "topology",
+    "level",
+    "segment",
+    "nodes",
+    "rounds",
+    "avg_time",
+    "p50",
+    "p99",
+    "multicasts",
+    "multicast_deliveries",
+    "dropped",
+    "pacing",
+    "initial_p",
+    "k",
+    "tokens",
+    "loop",
+]
+
+
+class Topology:
+    def __init__(self, kind, segments=1):
+        self.kind = kind
+        self.segments = segments
+
+    def __str__(self):
+        return self.kind if self.kind == "ring" else f"{self.kind}:{self.segments}"
+
+
+def parse_topology(spec):
+    kind, _, value = spec.partition(":")
+    if kind == "ring" and not value:
+        return Topology("ring")
+    if kind == "segments" and value.isdigit() and int(value) > 0:
+        return Topology("segments", int(value))
+    raise argparse.ArgumentTypeError(
+        f"unknown topology {spec!r}, expected ring or segments:COUNT"
+    )
+
+
+class Coordinator:
+    # Reports arrive on the control sockets of all segments, each drained by
+    # the thread running that segment
+
+    def __init__(self, placement, base_port, k, wire="binary"):
+        self.placement = placement  # (first node, size) per segment
+        self.base_port = base_port
+        self.k = k
+        self.wire = wire
+        self.silent = [{} for _ in placement]  # token id -> silent rounds
+        self.stopped = {}  # (segment, token id) -> when STOP was sent
+        self.lock = threading.Lock()
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def report(self, segment, message):
+        if message["type"] != "silent":
+            return
+        token_id = message["token_id"]
+        with self.lock:
+            self.silent[segment][token_id] = message["silent"]
+            sent = self.stopped.get((segment, token_id))
+            if sent is None:
+                if all(counts.get(token_id, 0) >= self.k for counts in self.silent):
+                    for index in range(len(self.placement)):
+                        self.stop(index, token_id)
+            elif time.monotonic() - sent > STOP_RESEND:
+                # Still going round, the STOP did not make it
+                self.stop(segment, token_id)
+
+    def stop(self, segment, token_id):
+        # To every node, whoever holds the token ends it at its next hop
+        first, size = self.placement[segment]
+        message = encode_stop(token_id, self.wire)
+        for node in range(first, first + size):
+            self.sock.sendto(message, ("127.0.0.1", self.base_port + node))
+        self.stopped[(segment, token_id)] = time.monotonic()
+
+    def close(self):
+        self.sock.close()
+
+
+def segment_channels(index):
+    # Separate multicast groups per segment, so fireworks stay inside it
+    return {
+        "firework_group": f"239.254.{index}.1",
+        "firework_port": SEGMENT_MULTICAST_PORT + 2 * index,
+        "round_time_group": f"239.254.{index}.2",
+        "round_time_port": SEGMENT_MULTICAST_PORT + 2 * index + 1,
+    }
+
+
+def slowest(rows, key):
+    # Segments that ended before a full circuit have no round times
+    values = [row[key] for row in rows if row[key] not in (None, "")]
+    return max(values) if values else ""
+
+
+def level_rows(n, topology, segments, pacing, initial_p, k, tokens=1):
+    # One row per segment and one for the topology as a whole
+    shared = {
+        "n": n,
+        "topology": str(topology),
+        "pacing": str(pacing),
+        "initial_p": initial_p,
+        "k": k,
+        "tokens": tokens,
+        # Every segment runs the same loop
+        "loop": segments[0][1]["loop"] if segments else "",
+    }
+    rows = []
+    for index, (size, stats) in enumerate(segments):
+        rows.append(
+            {
+                **shared,
+                "level": "segment",
+                "segment": index,
+                "nodes": size,
+                "rounds": stats["rounds"],
+                "avg_time": stats["avg_time"],
+                "p50": stats["p50"],
+                "p99": stats["p99"],
+                "multicasts": stats["multicasts"],
+                "multicast_deliveries": stats["multicasts"] * size,
+                "dropped": stats["dropped"],
+            }
+        )
+    rows.append(
+        {
+            **shared,
+            "level": "topology",
+            "segment": "",
+            "nodes": n,
+            # The coordinator ends every segment together, a topology round
+            # waits for the slowest one
+            "rounds": max(row["rounds"] for row in rows),
+            "avg_time": slowest(rows, "avg_time"),
+            "p50": slowest(rows, "p50"),
+            "p99": slowest(rows, "p99"),
+            "multicasts": sum(row["multicasts"] for row in rows),
+            "multicast_deliveries": sum(row["multicast_deliveries"] for row in rows),
+            "dropped": sum(row["dropped"] for row in rows),
+        }
+    )
+    return rows
@@ -0,0 +1,251 @@
+import glob
+import mmap
+import os
+import socket
+import struct
+import tempfile
+
+from drops import set_buffer_sizes
+from wire import FIREWORK
+
+# How the nodes of a ring reach each other when they all run on one host.
+#   udp:   the original transport, tokens by UDP unicast, fireworks and
+#          terminations by multicast on the firework group
+#   unix:  AF_UNIX datagram sockets in a directory shared by the ring;
+#          Unix sockets have no multicast, a broadcast is one send per node
+#   shm:   tokens through a shared memory mailbox per node, fireworks and
+#          terminations as counters on a board shared by the ring, both
+#          files in the directory mapped by every node
+# Round times, token losses and the READY/DONE handshake always go over UDP
+# to the runner, and every node keeps its UDP token socket, so tokens can be
+# injected from outside whatever the transport. Fireworks are multicast on
+# the firework group in any case, that is what the listener counts; with
+# unix and shm the nodes just do not listen to it.
+TRANSPORTS = ("udp", "unix", "shm")
+DEFAULT_TRANSPORT = "udp"
+# tmpfs where there is one, so the shm mailboxes never reach a disk
+SHM_DIR = "/dev/shm" if os.path.isdir("/dev/shm") else None
+DEFAULT_TRANSPORT_DIR = os.path.join(SHM_DIR or tempfile.gettempdir(), "ring")
+BUFFER_SIZE = 1024
+
+# A mailbox is written by the previous node only and read by its owner:
+# two counters, then MAILBOX_SLOTS slots of a length and a message. The
+# writer fills a slot before it bumps the write counter, the reader takes
+# the message before it bumps the read counter.
+MAILBOX_SLOTS = 64
+SLOT_SIZE = 256
+INDEX = struct.Struct("Q")
+SLOT_HEADER = struct.Struct("H")
+WRITE_OFFSET = 0
+READ_OFFSET = INDEX.size
+MAILBOX_SIZE = 2 * INDEX.size + MAILBOX_SLOTS * SLOT_SIZE
+BOARD_TOKENS = 1024  # token ids the board has room for
+
+
+def make_transport_dir():
+    # A fresh directory for one ring, removed by the runner afterwards
+    return tempfile.mkdtemp(prefix="ring-", dir=SHM_DIR)
+
+
+def map_file(path, size, truncate=False):
+    # Shared between every process that maps the same file
+    fd = os.open(path, os.O_RDWR | os.O_CREAT | (os.O_TRUNC if truncate else 0))
+    try:
+        if os.fstat(fd).st_size < size:
+            os.ftruncate(fd, size)  # zero filled
+        return mmap.mmap(fd, size)
+    finally:
+        os.close(fd)
+
+
+def remove(path):
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
+def bind_unix(path, rcvbuf=None):
+    remove(path)  # left over by a node that was killed
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    sock.bind(path)
+    sock.setblocking(False)
+    set_buffer_sizes(sock, rcvbuf)
+    return sock
+
+
+class UnixTransport:
+    # <port>.token receives tokens, <port>.fw fireworks and terminations
+
+    def __init__(self, directory, port, next_port, rcvbuf=None):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.paths = [self.path(port, "token"), self.path(port, "fw")]
+        self.next_path = self.path(next_port, "token")
+        self.token_sock = bind_unix(self.paths[0], rcvbuf)
+        self.broadcast_sock = bind_unix(self.paths[1], rcvbuf)
+        self.out = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.out.setblocking(False)
+        self.peers = None
+        self.dropped = 0
+
+    def path(self, port, kind):
+        return os.path.join(self.directory, f"{port}.{kind}")
+
+    def deliver(self, data, path):
+        try:
+            self.out.sendto(data, path)
+        except BlockingIOError:
+            self.dropped += 1  # the node's queue is full
+        except OSError:
+            pass  # the node is gone, as a multicast nobody listens to
+
+    def send(self, data):
+        self.deliver(data, self.next_path)
+
+    def broadcast(self, kind, token_id, data):
+        if self.peers is None:
+            # Every node is bound before the first token moves
+            pattern = os.path.join(self.directory, "*.fw")
+            self.peers = [path for path in glob.glob(pattern) if path != self.paths[1]]
+        for path in self.peers:
+            self.deliver(data, path)
+
+    def receive(self):
+        return self.token_sock.recv(BUFFER_SIZE)
+
+    def poll(self, tokens, terminated):
+        pass  # broadcasts arrive on broadcast_sock
+
+    def close(self):
+        for sock in (self.token_sock, self.broadcast_sock, self.out):
+            sock.close()
+        for path in self.paths:
+            remove(path)
+
+
+class ShmTransport:
+    # <port>.mailbox is the node's mailbox, ring.board the board. A one byte
+    # datagram on <port>.bell wakes the node up when its mailbox has a token.
+    # The board needs no wakeup: it is read before every token is handled,
+    # which is the only time a firework matters.
+
+    def __init__(self, directory, port, next_port, rcvbuf=None):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.paths = [self.path(port, "mailbox"), self.path(port, "bell")]
+        self.next_mailbox = self.path(next_port, "mailbox")
+        self.next_bell = self.path(next_port, "bell")
+        self.inbox = map_file(self.paths[0], MAILBOX_SIZE, truncate=True)
+        self.outbox = None  # mapped on the first send, the next node is up
+        self.board_path = os.path.join(directory, "ring.board")
+        self.board = map_file(self.board_path, 2 * INDEX.size * BOARD_TOKENS)
+        # fireworks of token t at 2t, its termination flag at 2t + 1
+        self.counters = memoryview(self.board).cast("Q")
+        self.seen = {}
+        self.token_sock = bind_unix(self.paths[1], rcvbuf)
+        self.broadcast_sock = None
+        self.out = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.out.setblocking(False)
+        self.dropped = 0
+
+    def path(self, port, kind):
+        return os.path.join(self.directory, f"{port}.{kind}")
+
+    def send(self, data):
+        if self.outbox is None:
+            self.outbox = map_file(self.next_mailbox, MAILBOX_SIZE)
+        buf = self.outbox
+        (write,) = INDEX.unpack_from(buf, WRITE_OFFSET)
+        (read,) = INDEX.unpack_from(buf, READ_OFFSET)
+        if write - read >= MAILBOX_SLOTS or len(data) > SLOT_SIZE - SLOT_HEADER.size:
+            self.dropped += 1
+            return
+        offset = 2 * INDEX.size + (write % MAILBOX_SLOTS) * SLOT_SIZE
+        SLOT_HEADER.pack_into(buf, offset, len(data))
+        start = offset + SLOT_HEADER.size
+        buf[start : start + len(data)] = data
+        INDEX.pack_into(buf, WRITE_OFFSET, write + 1)
+        try:
+            self.out.sendto(b"\0", self.next_bell)
+        except OSError:
+            pass  # the bell is queued already, the token is in the mailbox
+
+    def broadcast(self, kind, token_id, data):
+        if token_id >= BOARD_TOKENS:
+            return
+        if kind == FIREWORK:
+            # Only the holder of a token fires for it, so there is a single
+            # writer per counter
+            self.counters[2 * token_id] += 1
+            self.seen[token_id] = self.counters[2 * token_id]  # not heard back
+        else:
+            self.counters[2 * token_id + 1] = 1
+
+    def receive(self):
+        try:
+            self.token_sock.recv(BUFFER_SIZE)
+        except BlockingIOError:
+            pass
+        buf = self.inbox
+        (write,) = INDEX.unpack_from(buf, WRITE_OFFSET)
+        (read,) = INDEX.unpack_from(buf, READ_OFFSET)
+        if read == write:
+            return None
+        offset = 2 * INDEX.size + (read % MAILBOX_SLOTS) * SLOT_SIZE
+        (size,) = SLOT_HEADER.unpack_from(buf, offset)
+        start = offset + SLOT_HEADER.size
+        data = buf[start : start + size]
+        INDEX.pack_into(buf, READ_OFFSET, read + 1)
+        return data
+
+    def poll(self, tokens, terminated):
+        for token_id, state in tokens.items():
+            if token_id >= BOARD_TOKENS:
+                continue
+            fireworks = self.counters[2 * token_id]
+            if fireworks != self.seen.get(token_id, 0):
+                state.heard += fireworks - self.seen.get(token_id, 0)
+                self.seen[token_id] = fireworks
+                state.silent = 0
+            if self.counters[2 * token_id + 1]:
+                terminated.add(token_id)
+
+    def close(self):
+        self.counters.release()
+        for mapping in (self.inbox, self.outbox, self.board):
+            if mapping is not None:
+                mapping.close()
+        self.token_sock.close()
+        self.out.close()
+        # The first node to leave removes the board, so the next ring in
+        # this directory starts from a clean one; the others keep their
+        # mapping of it
+        for path in self.paths + [self.board_path]:
+            remove(path)
+
+
+def open_transport(kind, directory, port, next_port, rcvbuf=None):
+    # None for udp, which process.main handles with its own sockets
+    if kind == "unix":
+        return UnixTransport(directory, port, next_port, rcvbuf)
+    if kind == "shm":
+        return ShmTransport(directory, port, next_port, rcvbuf)
+    return None
+
+
+def add_transport_arguments(parser):
+    parser.add_argument(
+        "--transport",
+        choices=TRANSPORTS,
+        default=DEFAULT_TRANSPORT,
+        help="How nodes on one host pass tokens and fireworks: udp, unix "
+        "sockets or shared memory",
+    )
+    parser.add_argument(
+        "--transport_dir",
+        type=str,
+        default=DEFAULT_TRANSPORT_DIR,
+        help="Directory shared by the nodes of a ring for unix and shm, one "
+        "per ring",
+    )
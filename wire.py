@@ -0,0 +1,266 @@
+import json
+import struct
+
+from histogram import LogHistogram
+
+# Every binary message has the same fixed 26 byte layout so that a receiver
+# can decode any of them with a single unpack:
+#
+#   version  B   WIRE_VERSION
+#   type     B   TOKEN, ROUND_TIME, FIREWORK, READY, DONE, HISTOGRAM,
+#                TOKEN_LOST, SILENT or STOP
+#   epoch    H   token epoch, bumped whenever a lost token is regenerated
+#                (0 for other types)
+#   token    H   which of the tokens in the ring a TOKEN, ROUND_TIME,
+#                FIREWORK, TOKEN_LOST, SILENT or STOP belongs to (0 for
+#                other types)
+#   sender   I   process id of the sender, for a token the node that
+#                injected or regenerated it
+#   round    I   token round, or the number of nodes a READY/DONE covers
+#   silent   I   silent rounds carried by the token or reported by SILENT
+#                (0 for other types),
+#                the number of buckets a HISTOGRAM carries, or the kernel
+#                receive drops of the sockets of the process sending DONE
+#   value    d   token timestamp, the duration of a round_time message, or
+#                the resident memory in bytes of the process sending DONE
+#
+# TOKEN_LOST is multicast on the round time group by a node that timed out
+# waiting for the token and injected a new one, round is the new epoch.
+# The node that terminates the ring also multicasts its terminating TOKEN
+# on the firework group.
+#
+# SILENT and STOP coordinate the segments of a ring-of-rings (topology.py).
+# Node 0 of every segment sends SILENT to the runner's control address each
+# time it forwards a token; the coordinator answers with STOP, sent to the
+# token socket of every node, once all segments are silent long enough.
+#
+# HISTOGRAM is the only message with a payload after the header: the
+# non-empty buckets of a LogHistogram, sent once by each node when it
+# terminates. The round field says which metric it is.
+#
+# JSON messages start with "{" and are kept for debugging. Receivers accept
+# both, so the format is negotiated by whoever injects the token.
+WIRE_VERSION = 2
+MESSAGE = struct.Struct("!BBHHIIId")
+
+TOKEN = 1
+ROUND_TIME = 2
+FIREWORK = 3
+READY = 4
+DONE = 5
+
+HISTOGRAM = 6
+TOKEN_LOST = 7
+SILENT = 8
+STOP = 9
+
+CONTROL_TYPES = {READY: "ready", DONE: "done"}
+
+SERVICE_TIME = 1  # token received -> token forwarded, per node
+METRICS = {SERVICE_TIME: "service_time"}
+
+WIRE_FORMATS = ("auto", "binary", "json")
+DEFAULT_WIRE = "auto"
+
+
+def message_format(data):
+    return "json" if data[:1] == b"{" else "binary"
+
+
+def encode_token(token, wire="binary"):
+    if wire == "json":
+        return json.dumps(token).encode()
+    return MESSAGE.pack(
+        WIRE_VERSION,
+        TOKEN,
+        token.get("epoch", 0),
+        token.get("token_id", 0),
+        token.get("sender", 0),
+        token["round"],
+        token.get("silent_rounds", 0),
+        token["timestamp"],
+    )
+
+
+def encode_round_time(duration, round_number, sender, wire="binary", token_id=0):
+    if wire == "json":
+        return json.dumps(
+            {
+                "type": "round_time",
+                "duration": duration,
+                "round": round_number,
+                "sender": sender,
+                "token_id": token_id,
+            }
+        ).encode()
+    return MESSAGE.pack(
+        WIRE_VERSION, ROUND_TIME, 0, token_id, sender, round_number, 0, duration
+    )
+
+
+def encode_firework(sender, round_number, wire="binary", token_id=0):
+    if wire == "json":
+        return json.dumps(
+            {
+                "type": "firework",
+                "sender": sender,
+                "round": round_number,
+                "token_id": token_id,
+            }
+        ).encode()
+    return MESSAGE.pack(
+        WIRE_VERSION, FIREWORK, 0, token_id, sender, round_number, 0, 0.0
+    )
+
+
+def encode_token_lost(sender, epoch, wire="binary", token_id=0):
+    if wire == "json":
+        return json.dumps(
+            {
+                "type": "token_lost",
+                "sender": sender,
+                "epoch": epoch,
+                "token_id": token_id,
+            }
+        ).encode()
+    return MESSAGE.pack(WIRE_VERSION, TOKEN_LOST, 0, token_id, sender, epoch, 0, 0.0)
+
+
+def encode_silent(sender, token_id, round_number, silent, wire="binary"):
+    if wire == "json":
+        return json.dumps(
+            {
+                "type": "silent",
+                "sender": sender,
+                "token_id": token_id,
+                "round": round_number,
+                "silent": silent,
+            }
+        ).encode()
+    return MESSAGE.pack(
+        WIRE_VERSION, SILENT, 0, token_id, sender, round_number, silent, 0.0
+    )
+
+
+def encode_stop(token_id, wire="binary"):
+    if wire == "json":
+        return json.dumps({"type": "stop", "token_id": token_id}).encode()
+    return MESSAGE.pack(WIRE_VERSION, STOP, 0, token_id, 0, 0, 0, 0.0)
+
+
+def encode_control(kind, sender, count=1, wire="binary", rss=0, drops=0):
+    # READY once a node is bound, DONE once it has terminated. An async
+    # worker sends one message covering all the nodes it hosts.
+    if wire == "json":
+        return json.dumps(
+            {
+                "type": CONTROL_TYPES[kind],
+                "sender": sender,
+                "count": count,
+                "rss": rss,
+                "drops": drops,
+            }
+        ).encode()
+    return MESSAGE.pack(WIRE_VERSION, kind, 0, 0, sender, count, drops, float(rss))
+
+
+def encode_histogram(sender, metric, histogram, wire="binary"):
+    if wire == "json":
+        return json.dumps(
+            {
+                "type": "histogram",
+                "sender": sender,
+                "metric": METRICS[metric],
+                "buckets": histogram.buckets(),
+            }
+        ).encode()
+    buckets = histogram.to_bytes()
+    header = MESSAGE.pack(
+        WIRE_VERSION, HISTOGRAM, 0, 0, sender, metric, len(histogram.buckets()), 0.0
+    )
+    return header + buckets
+
+
+def decode(data):
+    if data[:1] == b"{":
+        message = json.loads(data.decode())
+        message.setdefault("type", "token")
+        if message["type"] == "histogram":
+            message["histogram"] = LogHistogram.from_buckets(message.pop("buckets"))
+        return message
+
+    if len(data) < MESSAGE.size:
+        raise ValueError(f"Unexpected message size {len(data)}")
+    (
+        version,
+        kind,
+        epoch,
+        token_id,
+        sender,
+        round_number,
+        silent,
+        value,
+    ) = MESSAGE.unpack_from(data)
+    if version != WIRE_VERSION:
+        raise ValueError(f"Unsupported wire version {version}")
+    if kind == HISTOGRAM:
+        return {
+            "type": "histogram",
+            "sender": sender,
+            "metric": METRICS.get(round_number, str(round_number)),
+            "histogram": LogHistogram.from_bytes(data[MESSAGE.size :]),
+        }
+    if len(data) != MESSAGE.size:
+        raise ValueError(f"Unexpected message size {len(data)}")
+
+    if kind == TOKEN:
+        return {
+            "type": "token",
+            "sender": sender,
+            "round": round_number,
+            "silent_rounds": silent,
+            "timestamp": value,
+            "epoch": epoch,
+            "token_id": token_id,
+        }
+    if kind == ROUND_TIME:
+        return {
+            "type": "round_time",
+            "duration": value,
+            "round": round_number,
+            "sender": sender,
+            "token_id": token_id,
+        }
+    if kind == FIREWORK:
+        return {
+            "type": "firework",
+            "sender": sender,
+            "round": round_number,
+            "token_id": token_id,
+        }
+    if kind == TOKEN_LOST:
+        return {
+            "type": "token_lost",
+            "sender": sender,
+            "epoch": round_number,
+            "token_id": token_id,
+        }
+    if kind == SILENT:
+        return {
+            "type": "silent",
+            "sender": sender,
+            "token_id": token_id,
+            "round": round_number,
+            "silent": silent,
+        }
+    if kind == STOP:
+        return {"type": "stop", "token_id": token_id}
+    if kind in CONTROL_TYPES:
+        return {
+            "type": CONTROL_TYPES[kind],
+            "sender": sender,
+            "count": round_number,
+            "rss": int(value),
+            "drops": silent,
+        }
+    raise ValueError(f"Unknown message type {kind}")